@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+import os
+import struct
+
+# Reads the sample rate, channels, duration, bitrate and presence of cover art of MP3, FLAC and Ogg Opus files directly from their headers,
+# without spawning an ffprobe process for every song. Only the first few KB of the file are read (plus the last page for Opus durations).
+# Returns the same values ffprobe -show_streams would (bitrate is None for FLAC and Opus, like ffprobe's N/A).
+
+MP3_SCAN_SIZE = 64 * 1024 # How far after the ID3 tag we look for the first MPEG frame
+OGG_TAIL_SIZE = 64 * 1024 # The last Ogg page (with the final granule position) must start in that many bytes at the end of the file
+
+MPEG_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]} # By MPEG version bits (1, 2, 2.5)
+MPEG_BITRATES = { # kbps, by (MPEG1 or not, layer bits)
+    (True, 3): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (True, 1): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (False, 3): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (False, 1): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+
+FLAC_STREAMINFO = 0
+FLAC_PICTURE = 6
+
+class AudioHeader:
+    def __init__(self, sample_rate, channels, duration, bitrate, has_cover_art):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.duration = duration
+        self.bitrate = bitrate
+        self.has_cover_art = has_cover_art
+
+class HeaderError(Exception):
+    pass
+
+def read_exactly(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise HeaderError('Unexpected end of file')
+    return data
+
+def syncsafe_int(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+# Returns (end of the tag, whether it has an attached picture), or (0, False) if the file doesn't start with an ID3v2 tag
+def read_id3v2(f):
+    f.seek(0)
+    header = f.read(10)
+    if len(header) < 10 or header[:3] != b'ID3':
+        return 0, False
+    version, flags = header[3], header[5]
+    tag_end = 10 + syncsafe_int(header[6:10]) + (10 if flags & 0x10 else 0)
+    if version == 3 and flags & 0x80:
+        raise HeaderError('Unsynchronised ID3v2.3 tag') # Frame sizes don't match the file layout, let ffprobe deal with it
+
+    pos = 10
+    if flags & 0x40 and version >= 3:
+        f.seek(pos)
+        ext_size = read_exactly(f, 4)
+        pos += syncsafe_int(ext_size) if version == 4 else 4 + struct.unpack('>I', ext_size)[0]
+
+    frame_header_size = 6 if version == 2 else 10
+    picture_frame = b'PIC' if version == 2 else b'APIC'
+    while pos + frame_header_size <= tag_end:
+        f.seek(pos)
+        frame_header = read_exactly(f, frame_header_size)
+        if frame_header[0] == 0: # Padding
+            break
+        if version == 2:
+            frame_id, frame_size = frame_header[:3], int.from_bytes(frame_header[3:6], 'big')
+        else:
+            frame_id = frame_header[:4]
+            frame_size = syncsafe_int(frame_header[4:8]) if version == 4 else struct.unpack('>I', frame_header[4:8])[0]
+        if frame_id == picture_frame:
+            return tag_end, True
+        pos += frame_header_size + frame_size
+    return tag_end, False
+
+def parse_mpeg_frame_header(data):
+    if len(data) < 4 or data[0] != 0xFF or data[1] & 0xE0 != 0xE0:
+        return None
+    version = (data[1] >> 3) & 3
+    layer = (data[1] >> 1) & 3
+    bitrate_index = data[2] >> 4
+    sample_rate_index = (data[2] >> 2) & 3
+    if version == 1 or layer == 0 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+    mpeg1 = version == 3
+    sample_rate = MPEG_SAMPLE_RATES[version][sample_rate_index]
+    bitrate = MPEG_BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+    padding = (data[2] >> 1) & 1
+    channels = 1 if data[3] >> 6 == 3 else 2
+    if layer == 3: # Layer I
+        samples_per_frame = 384
+        frame_size = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        samples_per_frame = 1152 if mpeg1 or layer == 2 else 576
+        frame_size = samples_per_frame // 8 * bitrate // sample_rate + padding
+    return mpeg1, layer, sample_rate, bitrate, channels, samples_per_frame, frame_size
+
+def read_mp3_header(f, file_size):
+    audio_start, has_cover_art = read_id3v2(f)
+    f.seek(audio_start)
+    data = f.read(MP3_SCAN_SIZE)
+    for pos in range(len(data) - 4):
+        frame = parse_mpeg_frame_header(data[pos:pos+4])
+        # Make sure this isn't a random 0xFFE pattern by checking the next frame is where it should be
+        if frame is not None and (pos + frame[6] + 4 > len(data) or parse_mpeg_frame_header(data[pos+frame[6]:pos+frame[6]+4]) is not None):
+            break
+    else:
+        raise HeaderError('No MPEG frame found')
+    mpeg1, layer, sample_rate, bitrate, channels, samples_per_frame, frame_size = frame
+
+    # VBR files start with a Xing/Info (LAME) or VBRI header telling the number of frames and bytes
+    side_info_size = (32 if channels == 2 else 17) if mpeg1 else (17 if channels == 2 else 9)
+    xing_pos = pos + 4 + side_info_size
+    vbri_pos = pos + 4 + 32
+    num_frames = num_bytes = None
+    if data[xing_pos:xing_pos+4] in (b'Xing', b'Info'):
+        flags = struct.unpack('>I', data[xing_pos+4:xing_pos+8])[0]
+        fields_pos = xing_pos + 8
+        if flags & 1:
+            num_frames = struct.unpack('>I', data[fields_pos:fields_pos+4])[0]
+            fields_pos += 4
+        if flags & 2:
+            num_bytes = struct.unpack('>I', data[fields_pos:fields_pos+4])[0]
+        if data[xing_pos:xing_pos+4] == b'Info': # CBR, the frame bitrate is the right one
+            num_bytes = None
+    elif data[vbri_pos:vbri_pos+4] == b'VBRI':
+        num_bytes, num_frames = struct.unpack('>II', data[vbri_pos+10:vbri_pos+18])
+
+    if num_frames:
+        duration = num_frames * samples_per_frame / sample_rate
+        if num_bytes:
+            bitrate = int(num_bytes * 8 / duration)
+    else:
+        audio_end = file_size
+        f.seek(max(file_size - 128, 0))
+        if f.read(3) == b'TAG': # ID3v1
+            audio_end -= 128
+        duration = (audio_end - audio_start - pos) * 8 / bitrate
+    return AudioHeader(sample_rate, channels, duration, bitrate, has_cover_art)
+
+def read_flac_header(f):
+    audio_start, has_cover_art = read_id3v2(f) # Not allowed by the spec, but it happens
+    f.seek(audio_start)
+    if read_exactly(f, 4) != b'fLaC':
+        raise HeaderError('Not a FLAC file')
+    sample_rate = channels = duration = None
+    while True:
+        block_header = read_exactly(f, 4)
+        block_type = block_header[0] & 0x7F
+        block_size = int.from_bytes(block_header[1:4], 'big')
+        if block_type == FLAC_STREAMINFO:
+            streaminfo = read_exactly(f, block_size)
+            info = int.from_bytes(streaminfo[10:18], 'big')
+            sample_rate = info >> 44
+            channels = ((info >> 41) & 7) + 1
+            total_samples = info & 0xFFFFFFFFF
+            duration = total_samples / sample_rate if sample_rate else None
+        else:
+            if block_type == FLAC_PICTURE:
+                has_cover_art = True
+            f.seek(block_size, os.SEEK_CUR)
+        if block_header[0] & 0x80: # Last metadata block
+            break
+    if sample_rate is None:
+        raise HeaderError('No STREAMINFO block')
+    return AudioHeader(sample_rate, channels, duration, None, has_cover_art)
+
+# Yields the packets at the start of an Ogg stream
+def read_ogg_packets(f):
+    packet = b''
+    while True:
+        page_header = f.read(27)
+        if len(page_header) < 27:
+            return
+        if page_header[:4] != b'OggS':
+            raise HeaderError('Invalid Ogg page')
+        segment_table = read_exactly(f, page_header[26])
+        for segment_size in segment_table:
+            packet += read_exactly(f, segment_size)
+            if segment_size < 255:
+                yield packet
+                packet = b''
+
+def read_opus_header(f, file_size):
+    f.seek(0)
+    packets = read_ogg_packets(f)
+    head = next(packets, b'')
+    if head[:8] != b'OpusHead':
+        raise HeaderError('Not an Opus file')
+    channels = head[9]
+    pre_skip = struct.unpack('<H', head[10:12])[0]
+
+    tags = next(packets, b'')
+    has_cover_art = False
+    if tags[:8] == b'OpusTags':
+        vendor_size = struct.unpack('<I', tags[8:12])[0]
+        pos = 12 + vendor_size
+        num_comments = struct.unpack('<I', tags[pos:pos+4])[0]
+        pos += 4
+        for i in range(num_comments):
+            comment_size = struct.unpack('<I', tags[pos:pos+4])[0]
+            if tags[pos+4:pos+4+23].upper() == b'METADATA_BLOCK_PICTURE=':
+                has_cover_art = True
+                break
+            pos += 4 + comment_size
+
+    f.seek(max(file_size - OGG_TAIL_SIZE, 0))
+    tail = f.read()
+    last_page = tail.rfind(b'OggS')
+    if last_page < 0 or len(tail) < last_page + 14:
+        raise HeaderError('Last Ogg page not found')
+    granule = struct.unpack('<q', tail[last_page+6:last_page+14])[0]
+    # Opus always decodes at 48kHz
+    return AudioHeader(48000, channels, max(granule - pre_skip, 0) / 48000, None, has_cover_art)
+
+# Returns an AudioHeader, or None if the format isn't supported or the file couldn't be parsed (use ffprobe for those)
+def read_audio_header(path):
+    extension = path[path.rfind('.')+1:].lower()
+    try:
+        file_size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            if extension == 'mp3':
+                return read_mp3_header(f, file_size)
+            elif extension == 'flac':
+                return read_flac_header(f)
+            elif extension == 'opus':
+                return read_opus_header(f, file_size)
+    except (HeaderError, struct.error, IndexError, ZeroDivisionError):
+        pass
+    return None
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+import sys
+import time
+import argparse
+import subprocess
+import sqlite3
+import fingerprint_matcher
+
+SCORE_TOLERANCE = 1e-6
+
+parser = argparse.ArgumentParser(
+    description='Matches the songs of two song DBs with both the chromaprint matcher binary and the NumPy matcher, then compares their results and timings.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('src_db', metavar='src db', type=str, help='Song database built by build_song_db.py')
+parser.add_argument('dst_db', metavar='dst db', type=str, help='Song database built by build_song_db.py')
+parser.add_argument('-t', '--threshold', type=float, default=0.98, help='Immediate and partial match threshold')
+parser.add_argument('-d', '--duration-diff', type=int, default=fingerprint_matcher.DEFAULT_MAX_DURATION_DIFF, help='Largest difference in seconds between two matches')
+args = parser.parse_args()
+
+# (id, duration, [fingerprint, ...]) of each song
+def import_songs(db_path):
+    db = sqlite3.connect(db_path)
+    if db.execute("SELECT value FROM info WHERE tag == 'fingerprint_format'").fetchone() != ('raw_int32le',):
+        print(f'{db_path} uses an old fingerprint format, convert it with migrate_song_db.py first')
+        sys.exit(-1)
+    segments = {}
+    if db.execute("SELECT name FROM sqlite_master WHERE type == 'table' AND name == 'fingerprint_segments'").fetchone() is not None:
+        for content_hash, fingerprint in db.execute('SELECT content_hash, fingerprint FROM fingerprint_segments ORDER BY content_hash, segment'):
+            segments.setdefault(content_hash, []).append(fingerprint)
+    songs = [(rowid, duration, [fingerprint, *segments.get(content_hash, [])])
+             for rowid, duration, fingerprint, content_hash in db.execute('SELECT rowid, duration, fingerprint, content_hash FROM songs')]
+    db.close()
+    return songs
+
+src_songs = import_songs(args.src_db)
+dst_songs = import_songs(args.dst_db)
+print(f'{len(src_songs)} source songs, {len(dst_songs)} destination songs')
+
+start_time = time.time()
+matcher_args = ['./chromaprint_matcher', '--raw-prints', '-i', str(args.threshold), '-p', str(args.threshold), '-d', str(args.duration_diff)]
+with subprocess.Popen(matcher_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True) as matcher:
+    for songs in [dst_songs, src_songs]:
+        for song_id, duration, prints in songs:
+            matcher.stdin.write(f'{song_id} {duration} {":".join(fingerprint.hex() for fingerprint in prints)}\n')
+        matcher.stdin.write('\n')
+    matcher.stdin.close()
+    rust_matches = {}
+    for line in matcher.stdout:
+        src_id, dst_id, score = line.split()
+        rust_matches[(int(src_id), int(dst_id))] = float(score)
+if matcher.returncode != 0:
+    print('Chromaprint matcher failed')
+    sys.exit(-1)
+rust_time = time.time() - start_time
+print(f'chromaprint_matcher: {len(rust_matches)} matches in {rust_time:.2f}s (including sending the prints)')
+
+start_time = time.time()
+src_prints = fingerprint_matcher.SongPrints(src_songs)
+dst_prints = fingerprint_matcher.SongPrints(dst_songs)
+load_time = time.time() - start_time
+matches = fingerprint_matcher.find_matches(src_prints, dst_prints, args.duration_diff, args.threshold, args.threshold)
+numpy_time = time.time() - start_time
+numpy_matches = {(src_id, dst_id): float(score) for src_id, dst_id, score in matches}
+print(f'fingerprint_matcher.py: {len(numpy_matches)} matches in {numpy_time:.2f}s (including {load_time:.2f}s building the matrices)')
+
+# The scores are the same float32, but Rust prints them with fewer digits (and 1.0 as 1)
+different_scores = [pair for pair in rust_matches.keys() & numpy_matches.keys() if abs(rust_matches[pair] - numpy_matches[pair]) >= SCORE_TOLERANCE]
+if rust_matches.keys() == numpy_matches.keys() and not different_scores:
+    print('Same matches and scores')
+else:
+    for src_id, dst_id in sorted(rust_matches.keys() - numpy_matches.keys()):
+        print(f'Only in chromaprint_matcher: {src_id} {dst_id} {rust_matches[(src_id, dst_id)]}')
+    for src_id, dst_id in sorted(numpy_matches.keys() - rust_matches.keys()):
+        print(f'Only in fingerprint_matcher.py: {src_id} {dst_id} {numpy_matches[(src_id, dst_id)]}')
+    for src_id, dst_id in sorted(different_scores):
+        print(f'Different scores: {src_id} {dst_id} {rust_matches[(src_id, dst_id)]} --- {numpy_matches[(src_id, dst_id)]}')
+    sys.exit(-1)
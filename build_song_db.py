@@ -1,54 +1,51 @@
 #!/usr/bin/env python3
 import os
 import sys
-import uuid
-import shutil
+import json
+import argparse
+import contextlib
+import signal
 import subprocess
 import queue
 import threading
 import sqlite3
-import scipy
+import hashlib
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import scipy.signal
 import numpy
 import acoustid
-import tempfile
+import chromaprint
 import traceback
-from time import sleep
-from scipy import signal
-from scipy.io import wavfile
+from time import monotonic, perf_counter, sleep
 from numpy.lib.scimath import log10
-
-from audioread import rawread
-from audioread import gstdec
+from audio_header import read_audio_header
+from song_db import create_tables, migrate_fingerprints, remove_unused_analysis, artist_shard, frequency_cutoff_search_batch, SPECTRUM_DB_DTYPE, CUTOFF_SEARCH_SEGMENT_WIDTH, CUTOFF_MIN_DB_DROP, CUTOFF_LOWEST_LEVEL
 
 QUEUE_SIZE = 128
-NUM_THREADS = 16
+NUM_WORKERS = os.cpu_count() # Songs are analyzed in a pool of processes, so the FFTs don't all wait on the same GIL
+NUM_THREADS = NUM_WORKERS # Those threads only wait on the process pool
+DECODE_CHUNK_FRAMES = 65536 # Audio frames read from the decoder's stdout at a time
+HASH_CHUNK_SIZE = 1 << 20
+FINGERPRINT_SEGMENT_LENGTH = acoustid.MAX_AUDIO_LENGTH # Songs get one fingerprint per window of that many seconds, the first one is the song's fingerprint
+FINGERPRINT_MIN_SEGMENT_LENGTH = 20 # A shorter tail at the end of a song doesn't get its own segment
+WRITE_BATCH_SIZE = 64 # Results are committed when we have that many,
+WRITE_BATCH_SECONDS = 2 # or when the oldest uncommitted result is that old
+STATS_INTERVAL = 30 # Seconds between two JSON lines of build stats
 
-# Cutoff frequency search parameters
+# Spectrum estimation parameters (the cutoff search ones are in song_db.py)
 FFT_LENGTH = 1024
-CUTOFF_SEARCH_START_FREQ = 5000 # There's no sense looking for a cutoff lower than 5kHz, if there's a song that poorly encoded I can only hope it's "artistic choice"
-CUTOFF_SEARCH_SEGMENT_WIDTH = 50 # Distance to lookahead for the drop, as a fraction of the frequency (search space)
-CUTOFF_MIN_DB_DROP = 15 # If we see a drop this many dB tall in a segment, we found the cutoff
-CUTOFF_LOWEST_LEVEL = +15 # If we reach a level this many dB above the floor, there must not have been a sharp drop, so we cutoff here.
-
-if len(sys.argv) < 3:
-    print('Usage: '+sys.argv[0]+' <archive dir> <db file>')
-    sys.exit(-1)
-SRC = sys.argv[1]
-DB_FILENAME = sys.argv[2]
-
-ARTISTS_PATH = os.path.join(SRC, 'Artists')
-if not os.path.exists(ARTISTS_PATH):
-    print('Invalid archive dir, no Artists folder')
-    sys.exit(-1)
-    
-artist_queue = queue.Queue(QUEUE_SIZE)
-results_queue = queue.Queue(QUEUE_SIZE)
-threads = []
-tempfile.tempdir = '.'
-tmpdir = tempfile.mkdtemp(prefix='pma-build-song-db-tmp')
 
-def has_cover_art_async(path):
-    return subprocess.Popen(['ffprobe', '-show_streams', path], stderr=subprocess.DEVNULL, stdout=subprocess.PIPE)
+# The median power of each frequency bin is estimated from a histogram of the segments' power in dB,
+# so memory stays the same no matter the song length (~7MB per channel with these values)
+SPECTRUM_HISTOGRAM_MIN_DB = -300 # Anything quieter counts as digital silence
+SPECTRUM_HISTOGRAM_MAX_DB = +50
+SPECTRUM_HISTOGRAM_RESOLUTION_DB = 0.1
+
+# The tools get their own session, so a Ctrl+C in the terminal doesn't kill them while the workers finish their songs
+def probe_song(path):
+    return subprocess.check_output(['ffprobe', '-show_streams', path], stderr=subprocess.DEVNULL, start_new_session=True).decode()
 
 def find_bitrate_in_ffprobe_output(output):
     for line in output.split('\n'):
@@ -56,84 +53,325 @@ def find_bitrate_in_ffprobe_output(output):
             return int(line[len('bit_rate='):])
     return None
 
+def find_audio_format_in_ffprobe_output(output):
+    stream = {}
+    for line in output.split('\n'):
+        if line == '[/STREAM]':
+            if stream.get('codec_type') == 'audio':
+                return int(stream['sample_rate']), int(stream['channels'])
+            stream = {}
+        elif '=' in line:
+            key, value = line.split('=', 1)
+            stream[key] = value
+    raise ValueError('No audio stream found')
+
 def frequency_cutoff_search(power_db, freq, dx, db_drop, lowest_level):
-    start_pos = int(CUTOFF_SEARCH_START_FREQ * len(power_db) / freq)
-    pos_to_freq = freq/len(power_db)/2
-    for i in range(start_pos, len(power_db)-dx):
-        if power_db[i] - power_db[i+dx] > db_drop:
-            return int(i+dx/2) * pos_to_freq
-        if power_db[i] - power_db[-1] < lowest_level:
+    return float(frequency_cutoff_search_batch(numpy.asarray(power_db)[numpy.newaxis], numpy.array([freq]), dx, db_drop, lowest_level)[0])
+
+# Streaming equivalent of summing scipy.signal.welch(channel, freq, nperseg=FFT_LENGTH, average='median') over the first two channels
+class SpectrumAccumulator:
+    def __init__(self, freq, channels):
+        self.freq = freq
+        self.channels = min(channels, 2)
+        self.window = scipy.signal.get_window('hann', FFT_LENGTH)
+        self.scale = 1.0 / (freq * (self.window*self.window).sum())
+        self.step = FFT_LENGTH - FFT_LENGTH//2
+        self.num_bins = FFT_LENGTH//2 + 1
+        self.num_buckets = int(round((SPECTRUM_HISTOGRAM_MAX_DB - SPECTRUM_HISTOGRAM_MIN_DB) / SPECTRUM_HISTOGRAM_RESOLUTION_DB))
+        self.histograms = numpy.zeros((self.channels, self.num_bins * self.num_buckets), dtype=numpy.uint32)
+        self.bin_offsets = numpy.arange(self.num_bins) * self.num_buckets
+        self.pending = numpy.zeros((0, self.channels), dtype=numpy.float32)
+        self.num_segments = 0
+
+    def feed(self, audio):
+        audio = numpy.concatenate((self.pending, audio[:, :self.channels]))
+        num_segments = max(0, (len(audio) - FFT_LENGTH) // self.step + 1)
+        if num_segments > 0:
+            for channel in range(self.channels):
+                segments = numpy.lib.stride_tricks.sliding_window_view(audio[:, channel], FFT_LENGTH)[::self.step][:num_segments]
+                self.add_segments(channel, segments)
+            self.num_segments += num_segments
+        self.pending = audio[num_segments*self.step:]
+
+    def add_segments(self, channel, segments):
+        segments = segments - segments.mean(axis=1, keepdims=True)
+        spectrum = numpy.fft.rfft(segments * self.window, axis=1)
+        power = (spectrum.real**2 + spectrum.imag**2) * self.scale
+        power[:, 1:-1] *= 2
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            power_db = 10*numpy.log10(power)
+        buckets = numpy.floor((power_db - SPECTRUM_HISTOGRAM_MIN_DB) / SPECTRUM_HISTOGRAM_RESOLUTION_DB)
+        buckets = numpy.clip(numpy.nan_to_num(buckets, nan=0), 0, self.num_buckets-1).astype(numpy.intp)
+        indexes, counts = numpy.unique(buckets + self.bin_offsets, return_counts=True)
+        self.histograms[channel, indexes] += counts.astype(numpy.uint32)
+
+    def bucket_power(self, buckets):
+        power = 10**((SPECTRUM_HISTOGRAM_MIN_DB + (buckets + 0.5) * SPECTRUM_HISTOGRAM_RESOLUTION_DB) / 10)
+        power[buckets == 0] = 0
+        return power
+
+    def median_bias(self):
+        # Same correction scipy applies to the median of the segments, to make it an estimate of the mean
+        ii_2 = 2 * numpy.arange(1., (self.num_segments-1) // 2 + 1)
+        return 1 + numpy.sum(1. / (ii_2 + 1) - 1. / ii_2)
+
+    def power(self):
+        if self.num_segments == 0:
+            return None
+        cumulative = numpy.cumsum(self.histograms.reshape(self.channels, self.num_bins, self.num_buckets), axis=2)
+        lower = numpy.argmax(cumulative > (self.num_segments - 1) // 2, axis=2)
+        upper = numpy.argmax(cumulative > self.num_segments // 2, axis=2)
+        median = (self.bucket_power(lower) + self.bucket_power(upper)) / 2
+        return numpy.sum(median, axis=0) / self.median_bias()
+
+# Yields blocks of PCM (frames x channels float32) streamed straight from the decoder's stdout
+def decode_song(song_path, freq, channels):
+    decoder = subprocess.Popen(['ffmpeg', '-i', song_path, '-map', '0:a:0', '-f', 'f32le', '-acodec', 'pcm_f32le', '-ar', str(freq), '-ac', str(channels), '-'],
+                               stdin=subprocess.DEVNULL, stderr=subprocess.DEVNULL, stdout=subprocess.PIPE, start_new_session=True)
+    chunk_size = DECODE_CHUNK_FRAMES * channels * 4
+    with decoder:
+        while True:
+            data = decoder.stdout.read(chunk_size)
+            if not data:
+                break
+            block = numpy.frombuffer(data, dtype='<f4')
+            yield block[:len(block) - len(block) % channels].reshape(-1, channels)
+    if decoder.returncode != 0:
+        raise subprocess.CalledProcessError(decoder.returncode, decoder.args)
+
+@contextlib.contextmanager
+def timed(stage_times, stage):
+    start = perf_counter()
+    yield
+    stage_times[stage] = stage_times.get(stage, 0) + perf_counter() - start
+
+def analyze_pcm(pcm_blocks, freq, channels, stage_times):
+    # Fans out a single decode to the fingerprinters and the spectrum estimation, without ever holding the whole song in memory
+    segment_frames = freq*FINGERPRINT_SEGMENT_LENGTH # The first segment is the same length as acoustid.fingerprint_file
+    segments = []
+    fingerprinter = None
+    spectrum = SpectrumAccumulator(freq, channels)
+    num_frames = 0
+    while True:
+        with timed(stage_times, 'decode'): # Time spent waiting on ffmpeg
+            block = next(pcm_blocks, None)
+        if block is None:
             break
-    return freq
+        with timed(stage_times, 'fingerprint'):
+            pos = 0
+            while pos < len(block):
+                if (num_frames + pos) % segment_frames == 0:
+                    if fingerprinter is not None:
+                        segments.append(decode_fingerprint(fingerprinter.finish()))
+                    fingerprinter = chromaprint.Fingerprinter()
+                    fingerprinter.start(freq, channels)
+                end = min(len(block), pos + segment_frames - (num_frames + pos) % segment_frames)
+                # Same float to s16 conversion as ffmpeg's, so the prints stay bit-identical to the ones acoustid.fingerprint_file got
+                samples = numpy.clip(numpy.rint(block[pos:end] * 32768), -32768, 32767)
+                fingerprinter.feed(samples.astype('<i2').tobytes())
+                pos = end
+        with timed(stage_times, 'spectrum'):
+            spectrum.feed(block)
+        num_frames += len(block)
+    with timed(stage_times, 'fingerprint'):
+        if fingerprinter is None: # Empty song
+            fingerprinter = chromaprint.Fingerprinter()
+            fingerprinter.start(freq, channels)
+        if not segments or num_frames % segment_frames == 0 or num_frames % segment_frames >= freq*FINGERPRINT_MIN_SEGMENT_LENGTH:
+            segments.append(decode_fingerprint(fingerprinter.finish()))
+    with timed(stage_times, 'spectrum'):
+        power = spectrum.power()
+    return num_frames, segments, power
 
-def find_song_cutoff_frequency(song_path):
-    temp_file = os.path.join(tmpdir, uuid.uuid4().hex+'.wav')
-    subprocess.check_call(['ffmpeg', '-i', song_path, '-acodec', 'pcm_f32le', temp_file], stderr=subprocess.DEVNULL)
-    freq, audio = wavfile.read(temp_file)
-    os.remove(temp_file)
-    
-    if len(audio.shape) > 1 and audio.shape[1] > 1:
-        graph_freqs, powerL = scipy.signal.welch(audio[:, 0], freq, nperseg=FFT_LENGTH, average='median')
-        graph_freqs, powerR = scipy.signal.welch(audio[:, 1], freq, nperseg=FFT_LENGTH, average='median')
-        power = powerL + powerR
-    else:
-        graph_freqs, power = scipy.signal.welch(audio, freq, nperseg=FFT_LENGTH, average='median')
+# We store fingerprints already decoded, so the tools reading the DB can use them directly with numpy.frombuffer or a memory map
+def decode_fingerprint(compressed_fingerprint):
+    if isinstance(compressed_fingerprint, str):
+        compressed_fingerprint = compressed_fingerprint.encode()
+    return numpy.array(chromaprint.decode_fingerprint(compressed_fingerprint)[0], dtype='<u4').tobytes()
+
+# The normalized power curve is stored in the DB as float16, so the cutoffs can be recomputed without decoding (see recompute_cutoffs.py)
+def get_power_db(power):
+    if power is None:
+        return None
     max_power = numpy.max(power)
     if max_power == 0: # Some songs are mostly empty (e.g. acapellas), we can't meaningfully look for a cutoff
         return None
-    power_db = 10*log10(power/max_power)
+    return (10*log10(power/max_power)).astype(SPECTRUM_DB_DTYPE)
+
+def find_power_cutoff_frequency(power_db, freq):
+    if power_db is None:
+        return None
+    power_db = power_db.astype(numpy.float32)
+    return frequency_cutoff_search(power_db, freq, int(len(power_db)/CUTOFF_SEARCH_SEGMENT_WIDTH), CUTOFF_MIN_DB_DROP, CUTOFF_LOWEST_LEVEL)
 
-    return frequency_cutoff_search(power_db, freq, int(len(power)/CUTOFF_SEARCH_SEGMENT_WIDTH), CUTOFF_MIN_DB_DROP, CUTOFF_LOWEST_LEVEL)
+# Runs in the process pool, so this must not touch any of the main process' state
+def analyze_song(song_path):
+    stage_times = {}
+    with timed(stage_times, 'probe'):
+        header = read_audio_header(song_path)
+        if header is not None:
+            has_cover_art, bitrate = header.has_cover_art, header.bitrate
+            freq, channels = header.sample_rate, header.channels
+        else: # Format we can't parse ourselves, or a weird file
+            ffprobe_out = probe_song(song_path)
+            has_cover_art = 'DISPOSITION:attached_pic=1' in ffprobe_out
+            bitrate = find_bitrate_in_ffprobe_output(ffprobe_out)
+            freq, channels = find_audio_format_in_ffprobe_output(ffprobe_out)
 
-def process_song(artist, artist_path, albums_path, song_filename):
+    num_frames, segments, power = analyze_pcm(decode_song(song_path, freq, channels), freq, channels, stage_times)
+    fingerprint = segments[0]
+    with timed(stage_times, 'cutoff'):
+        power_db = get_power_db(power)
+        freq_cutoff = find_power_cutoff_frequency(power_db, freq)
+    spectrum = (freq, power_db.tobytes()) if power_db is not None else None
+    pcm_size = num_frames * channels * 4
+    return (int(num_frames / freq), bitrate, freq_cutoff, has_cover_art, fingerprint), spectrum, segments[1:], stage_times, pcm_size
+
+# Reading the file is much cheaper than decoding it, so renamed or moved songs are found in the cache by their content
+def hash_song(song_path):
+    content_hash = hashlib.blake2b(digest_size=16)
+    with open(song_path, 'rb') as f:
+        while True:
+            data = f.read(HASH_CHUNK_SIZE)
+            if not data:
+                break
+            content_hash.update(data)
+    return content_hash.digest()
+
+def find_cached_analysis(content_hash):
+    if not hasattr(thread_data, 'db'):
+        thread_data.db = sqlite3.connect(DB_FILENAME)
+    return thread_data.db.execute('SELECT duration, bitrate, freq_cutoff, has_cover_art, fingerprint FROM analysis_cache WHERE content_hash == ?', [content_hash]).fetchone()
+
+class AnalysisCrashed(Exception):
+    pass
+
+def new_analysis_pool(num_workers):
+    # forkserver rather than fork, since the worker processes get started after our threads
+    return concurrent.futures.ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('forkserver'), initializer=ignore_keyboard_interrupt)
+
+def replace_broken_pool(broken_pool):
+    global analysis_pool
+    with analysis_pool_lock:
+        if analysis_pool is broken_pool: # Only the first thread to see it broken replaces it
+            analysis_pool = new_analysis_pool(NUM_WORKERS)
+            broken_pool.shutdown(wait=False)
+
+# A pool process dying (OOM kill, crash in ffmpeg or libchromaprint) breaks the whole pool, and with it all the songs it was analyzing.
+# Those get a new pool and are analyzed again each in a process of its own, so only the song that crashes it again counts as failed
+def analyze_in_pool(song_path):
+    pool = analysis_pool
+    try:
+        return pool.submit(analyze_song, song_path).result()
+    except BrokenProcessPool:
+        replace_broken_pool(pool)
+    try:
+        with new_analysis_pool(1) as pool:
+            return pool.submit(analyze_song, song_path).result()
+    except BrokenProcessPool:
+        raise AnalysisCrashed('The analysis process crashed on '+song_path)
+
+def process_song(artist, artist_path, albums_path, song_filename, song_stat):
     song_path = os.path.join(artist_path, albums_path, song_filename)
     song_title = song_filename[:song_filename.rfind('.')]
     song_format = song_filename[song_filename.rfind('.')+1:]
     
-    print("Processing "+artist+' - '+song_filename)
-    has_cover_art_process = has_cover_art_async(song_path)
-    duration, fingerprint = acoustid.fingerprint_file(song_path)
-    
-    ffprobe_out, err = has_cover_art_process.communicate()
-    ffprobe_out = ffprobe_out.decode()
-    has_cover_art = 'DISPOSITION:attached_pic=1' in ffprobe_out
-    bitrate = find_bitrate_in_ffprobe_output(ffprobe_out)
-    freq_cutoff = find_song_cutoff_frequency(song_path)
-    
-    results_queue.put([artist, albums_path, song_title, song_format, int(duration), bitrate, freq_cutoff, has_cover_art, fingerprint])
+    stage_times = {}
+    with timed(stage_times, 'hash'):
+        content_hash = hash_song(song_path)
+    with timed(stage_times, 'cache_lookup'):
+        analysis = find_cached_analysis(content_hash)
+    spectrum = segments = None # Already in the DB if the analysis was cached
+    if analysis is None:
+        print("Processing "+artist+' - '+song_filename)
+        start = perf_counter()
+        analysis, spectrum, segments, analysis_stage_times, pcm_size = analyze_in_pool(song_path)
+        stage_times.update(analysis_stage_times)
+        stage_times['pool_wait'] = perf_counter() - start - sum(analysis_stage_times.values()) # Queuing, pickling, etc
+        build_stats.count('pcm_bytes', pcm_size)
+    else:
+        build_stats.count('cached_files')
+    build_stats.add_stage_times(stage_times)
+    build_stats.count('files')
+    build_stats.count('file_bytes', song_stat[0])
+    results_queue.put([(artist, albums_path, song_filename), [artist, albums_path, song_title, song_format, *analysis, *song_stat, content_hash, spectrum, segments]])
+
+def get_song_stat(path):
+    # A song whose size, mtime or inode changed was replaced or modified in place and must be analyzed again
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
 
-def process_artist(artist, rows):
+def find_artist_new_songs(artist, existing_db_entries):
     artist_path = os.path.join(ARTISTS_PATH, artist)
-    existing_db_entries = []
-    for row in rows:
-        row_albums_path, row_title, row_format = row
-        existing_db_entries.append(os.path.join(row_albums_path, row_title)+'.'+row_format)
+    new_songs = []
+    unchanged_songs = []
     for root, dirs, files in os.walk(artist_path):
         for song_file in files:
             albums_path = os.path.relpath(root, artist_path)
-            rel_path = os.path.join(albums_path, song_file)
-            if rel_path in existing_db_entries:
+            song_stat = get_song_stat(os.path.join(root, song_file))
+            db_stat = existing_db_entries.get((artist, os.path.join(albums_path, song_file)), False)
+            if db_stat == song_stat:
                 continue
-            retry = 0
-            while retry < 3:
-                try:
-                    process_song(artist, artist_path, albums_path, song_file)
-                    break
-                except Exception as e:
-                    retry += 1
-                    print("process_song exception: ", e)
-                    traceback.print_exc()
+            if db_stat is None: # Song from before we kept track of file changes, assume it's up to date
+                unchanged_songs.append([*song_stat, artist, albums_path, song_file[:song_file.rfind('.')]])
+                continue
+            new_songs.append([artist, artist_path, albums_path, song_file, song_stat])
+    return new_songs, unchanged_songs
 
-def worker():
-    while True:
-        process_artist(*artist_queue.get())
-        artist_queue.task_done()
+def in_shard(artist):
+    return SHARD is None or artist_shard(artist, SHARD[1]) == SHARD[0]
 
-def finish_processing_results():
-    db = sqlite3.connect(DB_FILENAME)
+def parse_shard(value):
+    try:
+        index, num_shards = [int(x) for x in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('Expected a shard like 2/8')
+    if num_shards < 1 or not 0 <= index < num_shards:
+        raise argparse.ArgumentTypeError(f'Invalid shard {value}, the index starts at 0 and must be less than the number of shards')
+    return index, num_shards
+
+def find_new_songs(db):
+    existing_db_entries = {}
+    for row in db.execute('SELECT artist, albums_path, title, format, size, mtime, inode FROM songs'):
+        artist, albums_path, title, fmt, size, mtime, inode = row
+        existing_db_entries[(artist, os.path.join(albums_path, title)+'.'+fmt)] = (size, mtime, inode) if size is not None else None
+
+    new_songs = []
+    unchanged_songs = []
+    with os.scandir(ARTISTS_PATH) as it:
+        for entry in it:
+            if entry.is_dir() and in_shard(entry.name):
+                artist_new_songs, artist_unchanged_songs = find_artist_new_songs(entry.name, existing_db_entries)
+                new_songs += artist_new_songs
+                unchanged_songs += artist_unchanged_songs
+    db.executemany('UPDATE songs SET size=?, mtime=?, inode=? WHERE artist == ? AND albums_path == ? AND title == ?', unchanged_songs)
+    db.commit()
+
+    # Biggest files first (file size is a good enough proxy for the decoding time),
+    # so a long DJ mix doesn't start last and keep the build running on a single core at the end
+    new_songs.sort(key=lambda song: song[4][0], reverse=True)
+    return new_songs
+
+def worker():
     while True:
-        process_results(db)
-        sleep(2)
+        song = song_queue.get()
+        retry = 0
+        while retry < 3 and not stopping.is_set():
+            try:
+                process_song(*song)
+                break
+            except AnalysisCrashed as e: # Already analyzed on its own, trying again would only crash again
+                print(e)
+                retry = 3
+            except Exception as e:
+                retry += 1
+                print("process_song exception: ", e)
+                traceback.print_exc()
+        if retry == 3: # Still remove it from the build journal, otherwise we could never finish resuming
+            build_stats.count('failed_files')
+            artist, artist_path, albums_path, song_filename, song_stat = song
+            results_queue.put([(artist, albums_path, song_filename), None])
+        song_queue.task_done()
 
 def start_thread(function):
     thread = threading.Thread(target=function)
@@ -141,18 +379,113 @@ def start_thread(function):
     thread.start()
     return thread
 
-def process_results(db):
-    result_list = []
-    while True:
-        try:
-            result_list.append(results_queue.get_nowait())
-        except queue.Empty:
-            break
-    db.executemany('''INSERT INTO songs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''', result_list)
+# Results are [journal key, song row], the song row is None if the song couldn't be analyzed
+def write_results(db, result_list):
+    journal_keys = [result[0] for result in result_list]
+    result_list = [result[1] for result in result_list if result[1] is not None]
+    db.executemany('''INSERT OR REPLACE INTO songs (artist, albums_path, title, format, duration, bitrate, freq_cutoff, has_cover_art, fingerprint, size, mtime, inode, content_hash)
+                      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', [result[:13] for result in result_list])
+    db.executemany('''INSERT OR REPLACE INTO analysis_cache (duration, bitrate, freq_cutoff, has_cover_art, fingerprint, content_hash)
+                      VALUES (?, ?, ?, ?, ?, ?)''', [result[4:9] + result[12:13] for result in result_list])
+    db.executemany('''INSERT OR REPLACE INTO spectra (content_hash, sample_rate, power_db) VALUES (?, ?, ?)''',
+                   [[result[12], *result[13]] for result in result_list if result[13] is not None])
+    db.executemany('''INSERT OR REPLACE INTO fingerprint_segments (content_hash, segment, fingerprint) VALUES (?, ?, ?)''',
+                   [[result[12], i+1, segment] for result in result_list if result[14] is not None for i, segment in enumerate(result[14])])
+    db.executemany('DELETE FROM build_journal WHERE artist == ? AND albums_path == ? AND filename == ?', journal_keys)
     db.commit()
-    for i in range(len(result_list)):
-        results_queue.task_done()
-        
+
+# The only thread writing to the DB. Blocks until results come in, then commits them in batches.
+# If a write fails (e.g. the DB is locked by another tool), the build stops: the workers skip their songs, which stay in the build journal,
+# and the results still coming in are dropped so nothing blocks on the queue
+def writer():
+    db = sqlite3.connect(DB_FILENAME)
+    while True:
+        result_list = [results_queue.get()]
+        deadline = monotonic() + WRITE_BATCH_SECONDS
+        while len(result_list) < WRITE_BATCH_SIZE:
+            try:
+                result_list.append(results_queue.get(timeout=max(0, deadline - monotonic())))
+            except queue.Empty:
+                break
+        if not writer_failed.is_set():
+            stage_times = {}
+            try:
+                with timed(stage_times, 'db_commit'):
+                    write_results(db, result_list)
+            except Exception:
+                print('Failed to write results to the DB, stopping the build')
+                traceback.print_exc()
+                db.rollback()
+                writer_failed.set()
+                stopping.set()
+            build_stats.add_stage_times(stage_times)
+        for i in range(len(result_list)):
+            results_queue.task_done()
+
+# Per stage timings and throughput, to see where the time goes in a build (and tune NUM_THREADS, QUEUE_SIZE, etc)
+class BuildStats:
+    def __init__(self, output):
+        self.output = output
+        self.lock = threading.Lock()
+        self.start_time = self.last_report_time = monotonic()
+        self.counters = {'files': 0, 'cached_files': 0, 'failed_files': 0, 'file_bytes': 0, 'pcm_bytes': 0}
+        self.last_report_counters = dict(self.counters)
+        self.stage_times = {}
+
+    def count(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] += value
+
+    def add_stage_times(self, stage_times):
+        with self.lock:
+            for stage, seconds in stage_times.items():
+                self.stage_times.setdefault(stage, []).append(seconds)
+
+    # Rates are over the last interval, or the whole build for the summary. Stage timings are always for the whole build.
+    def snapshot(self, summary):
+        with self.lock:
+            now = monotonic()
+            since = self.start_time if summary else self.last_report_time
+            since_counters = {counter: 0 for counter in self.counters} if summary else self.last_report_counters
+            interval = max(now - since, 1e-9)
+            stats = {
+                'elapsed': round(now - self.start_time, 1),
+                **self.counters,
+                'files_per_s': round((self.counters['files'] - since_counters['files']) / interval, 2),
+                'file_mb_per_s': round((self.counters['file_bytes'] - since_counters['file_bytes']) / interval / 1e6, 2),
+                'decoded_mb_per_s': round((self.counters['pcm_bytes'] - since_counters['pcm_bytes']) / interval / 1e6, 2),
+                'song_queue': song_queue.qsize(),
+                'results_queue': results_queue.qsize(),
+                'stages': {stage: {
+                    'count': len(times),
+                    'total': round(sum(times), 3),
+                    'p50': round(float(numpy.percentile(times, 50)), 4),
+                    'p99': round(float(numpy.percentile(times, 99)), 4),
+                } for stage, times in self.stage_times.items()},
+            }
+            if summary:
+                stats['summary'] = True
+            self.last_report_time = now
+            self.last_report_counters = dict(self.counters)
+        return stats
+
+    def report(self, summary=False):
+        stats = self.snapshot(summary)
+        print(json.dumps(stats), file=self.output, flush=True)
+        return stats
+
+    def reporter(self):
+        while True:
+            sleep(STATS_INTERVAL)
+            self.report()
+
+    def print_summary(self):
+        stats = self.report(summary=True)
+        print(f"Processed {stats['files']} songs in {stats['elapsed']}s ({stats['cached_files']} from the cache, {stats['failed_files']} failed), "
+              f"{stats['files_per_s']} songs/s, {stats['file_mb_per_s']}MB/s read, {stats['decoded_mb_per_s']}MB/s decoded")
+        for stage, stage_stats in sorted(stats['stages'].items(), key=lambda stage: -stage[1]['total']):
+            print(f"  {stage}: {stage_stats['total']}s total, p50 {stage_stats['p50']}s, p99 {stage_stats['p99']}s ({stage_stats['count']} times)")
+
 def process_removed_songs(db):
     db_cur = db.cursor()
     db_cur.execute('SELECT artist, albums_path, title, format FROM songs')
@@ -164,52 +497,120 @@ def process_removed_songs(db):
         if not os.path.exists(song_path):
             print('Removing deleted song from DB: '+song_path)
             to_remove.append(row)
+        elif not in_shard(artist): # The number of shards changed since the last build
+            print('Removing song of another shard from DB: '+song_path)
+            to_remove.append(row)
     db_cur.executemany('DELETE FROM songs WHERE artist == ? AND albums_path == ? AND title == ? AND format == ?', to_remove)
     db_cur.close()
     db.commit()
 
-db = sqlite3.connect(DB_FILENAME)
-db.execute('''CREATE TABLE IF NOT EXISTS songs (
-    artist TEXT NOT NULL,
-    albums_path TEXT NOT NULL,
-    title TEXT NOT NULL,
-    format TEXT NOT NULL,
-    duration INTEGER NOT NULL,
-    bitrate INTEGER,
-    freq_cutoff REAL,
-    has_cover_art INTEGER NOT NULL,
-    fingerprint TEXT NOT NULL,
-    UNIQUE(artist, albums_path, title)
-    )''')
-db.execute('''CREATE INDEX IF NOT EXISTS idx_artist ON songs(artist)''')
-db.execute('''CREATE TABLE IF NOT EXISTS info (tag text UNIQUE, value text)''')
-db.execute('''INSERT OR REPLACE INTO info VALUES ('songs_rel_path', ?)''', [os.path.relpath(ARTISTS_PATH, os.path.dirname(DB_FILENAME))])
-
-try:
-    print('Looking for removed songs')
-    process_removed_songs(db)
-
-    print('Looking for new songs')
-    for i in range(NUM_THREADS):
-        threads.append(start_thread(worker))
-
-    with os.scandir(ARTISTS_PATH) as it:
-        db_cur = db.cursor()
-        for entry in it:
-            while artist_queue.qsize() >= QUEUE_SIZE:
-                process_results(db)
-                sleep(2)
-            if entry.is_dir():
-                db_cur.execute('SELECT albums_path, title, format FROM songs WHERE artist=?', [entry.name])
-                rows = db_cur.fetchall()
-                artist_queue.put([entry.name, rows])
+# The list of songs left to analyze is saved in the DB, so an interrupted build can resume without walking the archive again
+def save_build_journal(db, new_songs):
+    db.execute('DELETE FROM build_journal')
+    db.executemany('INSERT INTO build_journal VALUES (?, ?, ?, ?, ?, ?)',
+                   [[artist, albums_path, song_filename, *song_stat] for artist, artist_path, albums_path, song_filename, song_stat in new_songs])
+    db.commit()
 
+def load_build_journal(db):
+    new_songs = []
+    removed_songs = []
+    for row in db.execute('SELECT artist, albums_path, filename, size, mtime, inode FROM build_journal ORDER BY size DESC').fetchall():
+        artist, albums_path, song_filename, size, mtime, inode = row
+        artist_path = os.path.join(ARTISTS_PATH, artist)
+        if os.path.exists(os.path.join(artist_path, albums_path, song_filename)):
+            new_songs.append([artist, artist_path, albums_path, song_filename, (size, mtime, inode)])
+        else:
+            removed_songs.append([artist, albums_path, song_filename])
+    db.executemany('DELETE FROM build_journal WHERE artist == ? AND albums_path == ? AND filename == ?', removed_songs)
     db.commit()
-    db.close()
+    return new_songs
 
-    start_thread(finish_processing_results)
-    artist_queue.join()
-    results_queue.join()
-except KeyboardInterrupt:
-    pass
-shutil.rmtree(tmpdir, ignore_errors=True)
+def ignore_keyboard_interrupt():
+    # Only the main process handles Ctrl+C, so the songs already being analyzed can finish and be saved (ffmpeg and ffprobe run in their own session)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Builds or updates the database of songs of a Pony Music Archive.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('archive', metavar='archive dir', type=str, help='The archive folder, containing the Artists folder')
+    parser.add_argument('db', metavar='db file', type=str, help='The song database to create or update')
+    parser.add_argument('--shard', type=parse_shard, help='Only build the artists of shard i out of N (written as i/N), merge the shard DBs with merge_song_db.py')
+    parser.add_argument('--stats-file', type=str, help=f'Append build stats as JSON lines to this file every {STATS_INTERVAL}s instead of stderr')
+    args = parser.parse_args()
+    SRC = args.archive
+    DB_FILENAME = args.db
+    SHARD = args.shard
+
+    ARTISTS_PATH = os.path.join(SRC, 'Artists')
+    if not os.path.exists(ARTISTS_PATH):
+        print('Invalid archive dir, no Artists folder')
+        sys.exit(-1)
+
+    song_queue = queue.Queue(QUEUE_SIZE)
+    results_queue = queue.Queue(QUEUE_SIZE)
+    threads = []
+    thread_data = threading.local()
+    stopping = threading.Event()
+    writer_failed = threading.Event()
+    build_stats = BuildStats(open(args.stats_file, 'a') if args.stats_file else sys.stderr)
+    analysis_pool = new_analysis_pool(NUM_WORKERS)
+    analysis_pool_lock = threading.Lock()
+
+    db = sqlite3.connect(DB_FILENAME)
+    # WAL lets other scripts read the DB during a build, and our threads look up the analysis cache without waiting on the writer
+    db.execute('PRAGMA journal_mode=WAL')
+    create_tables(db)
+    db.execute('''INSERT OR REPLACE INTO info VALUES ('songs_rel_path', ?)''', [os.path.relpath(ARTISTS_PATH, os.path.dirname(DB_FILENAME))])
+    if SHARD is not None:
+        db.execute('''INSERT OR REPLACE INTO info VALUES ('shard', ?)''', [f'{SHARD[0]}/{SHARD[1]}'])
+    else:
+        db.execute('''DELETE FROM info WHERE tag == 'shard' ''')
+    migrate_fingerprints(db)
+
+    try:
+        print('Looking for removed songs')
+        process_removed_songs(db)
+
+        new_songs = load_build_journal(db)
+        if new_songs:
+            print(f'Resuming interrupted build, {len(new_songs)} songs left')
+        else:
+            print('Looking for new or changed songs')
+            new_songs = find_new_songs(db)
+            print(f'Found {len(new_songs)} new or changed songs')
+            save_build_journal(db, new_songs)
+        db.close()
+
+        start_thread(writer)
+        start_thread(build_stats.reporter)
+        for i in range(NUM_THREADS):
+            threads.append(start_thread(worker))
+        for song in new_songs:
+            song_queue.put(song)
+
+        song_queue.join()
+        results_queue.join()
+    except KeyboardInterrupt:
+        print('Interrupted, saving the songs in progress. Run again to resume the build, or press Ctrl+C again to quit now')
+        stopping.set()
+        try:
+            while True:
+                try:
+                    song_queue.get_nowait()
+                except queue.Empty:
+                    break
+                song_queue.task_done()
+            song_queue.join()
+            results_queue.join()
+        except KeyboardInterrupt:
+            os._exit(-1)
+    analysis_pool.shutdown(wait=False, cancel_futures=True)
+    build_stats.print_summary()
+    if not stopping.is_set(): # An interrupted build may still find the songs left in the analysis cache
+        db = sqlite3.connect(DB_FILENAME)
+        remove_unused_analysis(db)
+        db.close()
+    if writer_failed.is_set():
+        print('The build stopped because the results could not be saved, run again to resume it')
+        sys.exit(-1)
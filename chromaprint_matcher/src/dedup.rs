@@ -0,0 +1,74 @@
+use super::matcher::*;
+use rayon::prelude::*;
+
+struct UnionFind {
+    parents: Vec<usize>,
+}
+
+impl UnionFind {
+    fn new(size: usize) -> Self {
+        Self { parents: (0..size).collect() }
+    }
+
+    fn find(&mut self, mut x: usize) -> usize {
+        while self.parents[x] != x {
+            self.parents[x] = self.parents[self.parents[x]]; // Path halving
+            x = self.parents[x];
+        }
+        x
+    }
+
+    fn union(&mut self, a: usize, b: usize) {
+        let (a, b) = (self.find(a), self.find(b));
+        if a != b {
+            self.parents[a.max(b)] = a.min(b);
+        }
+    }
+}
+
+pub struct DuplicateCluster {
+    pub songs: Vec<usize>, // Positions in the index, in increasing order
+    pub links: Vec<(usize, usize, f32, i32)>, // The matching pairs that put those songs together, with their score and offset
+}
+
+// Compares every pair of songs of the archive once (each song only looks at the ones after it in the duration-sorted list),
+// and groups the pairs scoring at least the partial threshold into clusters of duplicates
+pub fn find_duplicate_clusters(songs: &DurationIndex, params: &MatchParams, stats: &MatchStats) -> Vec<DuplicateCluster> {
+    let links: Vec<(usize, usize, f32, i32)> = (0..songs.len()).into_par_iter().flat_map_iter(|pos| {
+        let song = songs.song(pos);
+        let mut counts = PairCounts::default();
+        let song_keys = song_alignment_keys(song, params.max_offset);
+        let mut song_links = Vec::new();
+        for other_pos in songs.candidate_positions(song, pos + 1, params) {
+            if let Some((score, offset)) = counts.score_pair(song, &song_keys, songs.song(other_pos), params.match_partial_threshold, params.max_offset) {
+                if score >= params.match_partial_threshold {
+                    song_links.push((pos, other_pos, score, offset));
+                }
+            }
+        }
+        stats.add(&counts);
+        song_links
+    }).collect();
+
+    let mut clusters = UnionFind::new(songs.len());
+    for &(a, b, _, _) in links.iter() {
+        clusters.union(a, b);
+    }
+    let mut cluster_ids = vec![usize::MAX; songs.len()];
+    let mut result: Vec<DuplicateCluster> = Vec::new();
+    for &(a, b, score, offset) in links.iter() {
+        let root = clusters.find(a);
+        if cluster_ids[root] == usize::MAX {
+            cluster_ids[root] = result.len();
+            result.push(DuplicateCluster { songs: Vec::new(), links: Vec::new() });
+        }
+        result[cluster_ids[root]].links.push((a, b, score, offset));
+    }
+    for pos in 0..songs.len() {
+        let root = clusters.find(pos);
+        if cluster_ids[root] != usize::MAX {
+            result[cluster_ids[root]].songs.push(pos);
+        }
+    }
+    result
+}
@@ -0,0 +1,105 @@
+use super::song::Song;
+use memmap2::Mmap;
+use std::borrow::Cow;
+use std::fs::{self, File};
+use std::convert::TryInto;
+use std::io::{self, BufWriter, Write};
+
+// Songs already decoded, so a sweep of thresholds over the same archives doesn't parse and decode every print again each time.
+// Layout (little-endian): magic, number of songs, number of segments, then for each song its id (u64), duration (i32),
+// first segment (u32) and number of segments (u32, 4 bytes of padding after), then for each segment its offset (u64, in frames)
+// and length (u32, 4 bytes of padding after), then all the prints one after another as i32 frames.
+const INDEX_MAGIC: &[u8; 8] = b"CPMIDX02";
+const HEADER_SIZE: usize = 24;
+const SONG_ENTRY_SIZE: usize = 24;
+const SEGMENT_ENTRY_SIZE: usize = 16;
+
+fn invalid_data(message: &str) -> io::Error {
+    io::Error::new(io::ErrorKind::InvalidData, message.to_owned())
+}
+
+pub fn write_index(path: &str, songs: &[Song]) -> io::Result<()> {
+    let tmp_path = format!("{}.tmp", path);
+    let mut out = BufWriter::new(File::create(&tmp_path)?);
+    let num_segments: usize = songs.iter().map(|song| song.segments().count()).sum();
+    out.write_all(INDEX_MAGIC)?;
+    out.write_all(&(songs.len() as u64).to_le_bytes())?;
+    out.write_all(&(num_segments as u64).to_le_bytes())?;
+    let mut first_segment = 0u32;
+    for song in songs {
+        let id: u64 = song.label.parse().map_err(|_| invalid_data("Songs need an integer id to be saved in an index"))?;
+        let song_segments = song.segments().count() as u32;
+        out.write_all(&id.to_le_bytes())?;
+        out.write_all(&song.duration.to_le_bytes())?;
+        out.write_all(&first_segment.to_le_bytes())?;
+        out.write_all(&song_segments.to_le_bytes())?;
+        out.write_all(&[0u8; 4])?;
+        first_segment += song_segments;
+    }
+    let mut offset = 0u64;
+    for segment in songs.iter().flat_map(|song| song.segments()) {
+        out.write_all(&offset.to_le_bytes())?;
+        out.write_all(&(segment.len() as u32).to_le_bytes())?;
+        out.write_all(&[0u8; 4])?;
+        offset += segment.len() as u64;
+    }
+    for segment in songs.iter().flat_map(|song| song.segments()) {
+        for frame in segment.iter() {
+            out.write_all(&frame.to_le_bytes())?;
+        }
+    }
+    out.flush()?;
+    drop(out);
+    fs::rename(tmp_path, path) // So an interrupted build never leaves a truncated index behind
+}
+
+fn read_u64(data: &[u8], pos: usize) -> u64 {
+    u64::from_le_bytes(data[pos..pos + 8].try_into().unwrap())
+}
+
+fn read_u32(data: &[u8], pos: usize) -> u32 {
+    u32::from_le_bytes(data[pos..pos + 4].try_into().unwrap())
+}
+
+pub fn read_index(path: &str) -> io::Result<Vec<Song>> {
+    assert!(cfg!(target_endian = "little"), "Indexes are only supported on little-endian machines");
+    let file = File::open(path)?;
+    // The prints borrow from the mapping for the rest of the program, so it's never unmapped
+    let data: &'static Mmap = Box::leak(Box::new(unsafe { Mmap::map(&file)? }));
+    if data.len() < HEADER_SIZE || &data[..8] != INDEX_MAGIC {
+        return Err(invalid_data("Not a chromaprint_matcher index, or from an older version"));
+    }
+    let num_songs = read_u64(data, 8) as usize;
+    let num_segments = read_u64(data, 16) as usize;
+    let segments_start = HEADER_SIZE + num_songs * SONG_ENTRY_SIZE;
+    let prints_start = segments_start + num_segments * SEGMENT_ENTRY_SIZE;
+    if data.len() < prints_start || (data.len() - prints_start) % 4 != 0 {
+        return Err(invalid_data("Truncated index"));
+    }
+    let frames: &'static [i32] = unsafe {
+        // The mapping is page aligned and the tables before the prints are a multiple of 8 bytes long
+        std::slice::from_raw_parts(data[prints_start..].as_ptr() as *const i32, (data.len() - prints_start) / 4)
+    };
+    let segment = |index: usize| -> io::Result<Cow<'static, [i32]>> {
+        let pos = segments_start + index * SEGMENT_ENTRY_SIZE;
+        let offset = read_u64(data, pos) as usize;
+        let len = read_u32(data, pos + 8) as usize;
+        frames.get(offset..offset + len).map(Cow::Borrowed).ok_or_else(|| invalid_data("Truncated index"))
+    };
+
+    let mut songs = Vec::with_capacity(num_songs);
+    for pos in (HEADER_SIZE..segments_start).step_by(SONG_ENTRY_SIZE) {
+        let first_segment = read_u32(data, pos + 12) as usize;
+        let song_segments = read_u32(data, pos + 16) as usize;
+        if song_segments == 0 || first_segment + song_segments > num_segments {
+            return Err(invalid_data("Corrupt index"));
+        }
+        songs.push(Song {
+            label: read_u64(data, pos).to_string(),
+            print: segment(first_segment)?,
+            extra_segments: (first_segment + 1..first_segment + song_segments).map(|i| segment(i)).collect::<io::Result<_>>()?,
+            duration: read_u32(data, pos + 8) as i32,
+        });
+    }
+    Ok(songs)
+}
@@ -0,0 +1,70 @@
+use super::song::Song;
+
+// Songs that have more than this fraction of the archive for a key (silence, pure tones) don't make it selective, so we ignore those keys
+const MAX_KEY_SONGS_FRACTION: f32 = 0.01;
+const MIN_KEY_SONGS_LIMIT: usize = 100;
+
+// Inverted index from the top bits of each fingerprint frame to the songs that contain it, like AcoustID's lookup.
+// Songs are stored by their position in the duration-sorted song list, and each posting list is sorted,
+// so a lookup only counts the songs inside the duration window.
+pub struct KeyIndex {
+    key_bits: u32,
+    offsets: Vec<u32>, // Postings of key k are postings[offsets[k]..offsets[k+1]]
+    postings: Vec<u32>,
+}
+
+impl KeyIndex {
+    pub fn new(songs: &[&Song], key_bits: u32) -> Self {
+        let num_keys = 1usize << key_bits;
+
+        // Two passes over the songs, counting then filling the postings, so we never hold the keys of every song at once
+        let mut offsets = vec![0u32; num_keys + 1];
+        for song in songs.iter() {
+            for key in song_keys(&song.print, key_bits) {
+                offsets[key as usize + 1] += 1;
+            }
+        }
+        let max_key_songs = ((songs.len() as f32 * MAX_KEY_SONGS_FRACTION) as usize).max(MIN_KEY_SONGS_LIMIT) as u32;
+        for key in 0..num_keys {
+            if offsets[key + 1] > max_key_songs {
+                offsets[key + 1] = 0;
+            }
+            offsets[key + 1] += offsets[key];
+        }
+
+        let mut next = offsets.clone();
+        let mut postings = vec![0u32; offsets[num_keys] as usize];
+        for (pos, song) in songs.iter().enumerate() {
+            for key in song_keys(&song.print, key_bits) {
+                let key = key as usize;
+                if next[key] < offsets[key + 1] {
+                    postings[next[key] as usize] = pos as u32;
+                    next[key] += 1;
+                }
+            }
+        }
+
+        Self { key_bits, offsets, postings }
+    }
+
+    // Positions in [start, end) of the songs sharing at least min_hits keys with this print, in increasing order
+    pub fn lookup(&self, print: &[i32], start: usize, end: usize, min_hits: u32) -> Vec<usize> {
+        let mut hits = vec![0u32; end.saturating_sub(start)];
+        for key in song_keys(print, self.key_bits) {
+            let postings = &self.postings[self.offsets[key as usize] as usize..self.offsets[key as usize + 1] as usize];
+            let first = postings.partition_point(|&pos| (pos as usize) < start);
+            for &pos in postings[first..].iter().take_while(|&&pos| (pos as usize) < end) {
+                hits[pos as usize - start] += 1;
+            }
+        }
+        hits.iter().enumerate().filter(|(_, &count)| count >= min_hits).map(|(i, _)| start + i).collect()
+    }
+}
+
+// Distinct keys of a print
+fn song_keys(print: &[i32], key_bits: u32) -> Vec<u32> {
+    let mut keys: Vec<u32> = print.iter().map(|&frame| frame as u32 >> (32 - key_bits)).collect();
+    keys.sort_unstable();
+    keys.dedup();
+    keys
+}
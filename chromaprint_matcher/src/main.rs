@@ -2,9 +2,17 @@ mod song;
 use song::*;
 mod matcher;
 use matcher::*;
+mod key_index;
+mod index_file;
+use index_file::*;
+mod dedup;
+use dedup::*;
+mod protocol;
 
 use std::io::{self, BufRead};
 use std::error::Error;
+use std::sync::atomic::Ordering;
+use std::time::Instant;
 use rayon::prelude::*;
 use structopt::StructOpt;
 
@@ -19,6 +27,86 @@ struct Opt
 
     #[structopt(short, long)]
     partial_threshold: Option<f32>,
+
+    /// Only compare songs that share at least --min-key-hits keys (the top KEY_BITS bits of a frame) in an index, instead of every song.
+    /// Much faster on large archives, but a few real matches can be missed with low thresholds
+    #[structopt(long)]
+    key_bits: Option<u32>,
+
+    #[structopt(long)]
+    min_key_hits: Option<u32>,
+
+    /// Also align the prints shifted by up to MAX_OFFSET frames (about 0.124s each), to match songs with extra leading silence or a different intro pad.
+    /// The offsets voted for by the most frames with equal top bits are scored, and the best one is printed after the score (in frames, positive if the
+    /// second song starts later)
+    #[structopt(long)]
+    max_offset: Option<usize>,
+
+    /// Print up to TOP_K matches per source song with a score of at least --min-score, best first, as JSON lines:
+    /// {"src": <label>, "matches": [{"dst": <label>, "score": <score>, "offset": <frames>}, ...]}. The immediate and partial thresholds are ignored
+    #[structopt(long)]
+    top_k: Option<usize>,
+
+    #[structopt(long, default_value = "0.8")]
+    min_score: f32,
+
+    /// Find the duplicates inside a single archive (from stdin or --dst-index), comparing each pair once.
+    /// Prints each cluster of songs scoring at least the partial threshold with one another as a JSON line:
+    /// {"songs": [<label>, ...], "links": [[<label>, <label>, <score>, <offset>], ...]}
+    #[structopt(long)]
+    self_dedup: bool,
+
+    /// Print timings and how many candidate pairs were fully scored or abandoned early to stderr
+    #[structopt(long)]
+    bench: bool,
+
+    /// Prints are hex dumps of decoded fingerprints (the song DB format) instead of compressed base64
+    #[structopt(long)]
+    raw_prints: bool,
+
+    /// Read the songs from stdin and write the matches to stdout in the length-prefixed binary format described in protocol.rs,
+    /// instead of text lines. Each source song's matches are written as soon as they're found. --self-dedup still prints JSON lines
+    #[structopt(long)]
+    binary: bool,
+
+    /// Save the songs read from stdin ("<id> <duration> <print>" lines, or --binary records) to an index file for --dst-index/--src-index, then exit
+    #[structopt(long)]
+    build_index: Option<String>,
+
+    /// Memory-map the destination songs from an index file instead of reading them from stdin
+    #[structopt(long)]
+    dst_index: Option<String>,
+
+    /// Memory-map the source songs from an index file instead of reading them from stdin
+    #[structopt(long)]
+    src_index: Option<String>,
+}
+
+// Groups of lines separated by a blank line
+fn read_stdin_song_lines() -> io::Result<Vec<Vec<String>>> {
+    let mut groups = vec![Vec::new()];
+    let stdin = io::stdin();
+    for line in stdin.lock().lines() {
+        let line = line?.trim().to_owned();
+        if line.is_empty() {
+            groups.push(Vec::new());
+            continue
+        }
+        groups.last_mut().unwrap().push(line);
+    }
+    Ok(groups)
+}
+
+fn parse_songs(lines: &[String], raw_prints: bool) -> Vec<Song> {
+    lines.par_iter().map(|ref s| Song::new(s, raw_prints)).collect()
+}
+
+fn read_stdin_songs(opt: &Opt) -> io::Result<Vec<Vec<Song>>> {
+    if opt.binary {
+        protocol::read_song_groups(&mut io::stdin().lock())
+    } else {
+        Ok(read_stdin_song_lines()?.iter().map(|lines| parse_songs(lines, opt.raw_prints)).collect())
+    }
 }
 
 fn main() -> Result<(), Box<dyn Error>> {
@@ -33,31 +121,86 @@ fn main() -> Result<(), Box<dyn Error>> {
     if let Some(partial_threshold) = opt.partial_threshold {
         params.match_partial_threshold = partial_threshold;
     }
+    if let Some(key_bits) = opt.key_bits {
+        assert!(key_bits >= 1 && key_bits <= 24, "--key-bits must be between 1 and 24");
+        params.key_bits = Some(key_bits);
+    }
+    if let Some(min_key_hits) = opt.min_key_hits {
+        params.min_key_hits = min_key_hits;
+    }
+    if let Some(max_offset) = opt.max_offset {
+        params.max_offset = max_offset;
+    }
+
+    let start_time = Instant::now();
+    if let Some(path) = &opt.build_index {
+        let songs: Vec<_> = read_stdin_songs(&opt)?.into_iter().flatten().collect();
+        write_index(path, &songs)?;
+        return Ok(());
+    }
 
-    let mut dst_songs: Vec<String> = Vec::new();
-    let mut src_songs: Vec<String> = Vec::new();
+    let mut stdin_groups = if opt.dst_index.is_some() && (opt.src_index.is_some() || opt.self_dedup) {
+        Vec::new()
+    } else if opt.self_dedup {
+        vec![read_stdin_songs(&opt)?.into_iter().flatten().collect()]
+    } else {
+        read_stdin_songs(&opt)?
+    }.into_iter();
+    let dst_songs = match &opt.dst_index {
+        Some(path) => read_index(path)?,
+        None => stdin_groups.next().unwrap_or_default(),
+    };
+    let src_songs = match &opt.src_index {
+        Some(path) => read_index(path)?,
+        None if opt.self_dedup => Vec::new(),
+        None => stdin_groups.next().unwrap_or_default(),
+    };
+    let parse_time = start_time.elapsed();
+    let dst_index = DurationIndex::new(&dst_songs, &params);
+    let index_time = start_time.elapsed() - parse_time;
 
-    let stdin = io::stdin();
-    let mut end_of_dst = false;
-    for line in stdin.lock().lines() {
-        let line = line?.trim().to_owned();
-        if line.is_empty() {
-            end_of_dst = true;
-            continue
-        }
-        if !end_of_dst {
-            dst_songs.push(line);
-        } else {
-            src_songs.push(line);
+    let stats = MatchStats::default();
+    if opt.self_dedup {
+        for cluster in find_duplicate_clusters(&dst_index, &params, &stats) {
+            let songs: Vec<_> = cluster.songs.iter().map(|&pos| format!("\"{}\"", dst_index.song(pos).label)).collect();
+            let links: Vec<_> = cluster.links.iter().map(|&(a, b, score, offset)| format!("[\"{}\", \"{}\", {}, {}]", dst_index.song(a).label, dst_index.song(b).label, score, offset)).collect();
+            println!("{{\"songs\": [{}], \"links\": [{}]}}", songs.join(", "), links.join(", "));
         }
     }
-    let dst_songs: Vec<_> = dst_songs.par_iter().map(|ref s| Song::new(s)).collect();
-    let src_songs: Vec<_> = src_songs.par_iter().map(|ref s| Song::new(s)).collect();
-
-    src_songs.par_iter().for_each(|song| {
-        if let (Some(song_match), score) = find_fingerprint_match(&song, &dst_songs, &params) {
-            println!("{} {} {}", song.compressed_print, song_match.compressed_print, score.to_string());
+    src_songs.par_iter().try_for_each(|song| -> io::Result<()> {
+        if let Some(k) = opt.top_k {
+            let matches = find_top_matches(&song, &dst_index, &params, k.max(1), opt.min_score, &stats);
+            if matches.is_empty() {
+                return Ok(());
+            } else if opt.binary {
+                protocol::write_matches(&mut io::stdout().lock(), song, &matches)?;
+            } else {
+                let matches: Vec<_> = matches.iter().map(|(dst_song, score, offset)| format!("{{\"dst\": \"{}\", \"score\": {}, \"offset\": {}}}", dst_song.label, score, offset)).collect();
+                println!("{{\"src\": \"{}\", \"matches\": [{}]}}", song.label, matches.join(", "));
+            }
+        } else if let (Some(song_match), score, offset) = find_fingerprint_match(&song, &dst_index, &params, &stats) {
+            if opt.binary {
+                protocol::write_matches(&mut io::stdout().lock(), song, &[(song_match, score, offset)])?;
+            } else if params.max_offset > 0 {
+                println!("{} {} {} {}", song.label, song_match.label, score.to_string(), offset);
+            } else {
+                println!("{} {} {}", song.label, song_match.label, score.to_string());
+            }
         }
-    });
+        Ok(())
+    })?;
+    let match_time = start_time.elapsed() - parse_time - index_time;
+
+    if opt.bench {
+        let pairs_scored = stats.pairs_scored.load(Ordering::Relaxed);
+        let pairs_abandoned = stats.pairs_abandoned.load(Ordering::Relaxed);
+        let frames_compared = stats.frames_compared.load(Ordering::Relaxed);
+        let frames_total = stats.frames_total.load(Ordering::Relaxed).max(1);
+        eprintln!("{} src songs, {} dst songs", src_songs.len(), dst_songs.len());
+        eprintln!("parse {:.3}s, index {:.3}s, match {:.3}s", parse_time.as_secs_f64(), index_time.as_secs_f64(), match_time.as_secs_f64());
+        eprintln!("{} pairs scored, {} pairs abandoned early ({:.1}%)", pairs_scored, pairs_abandoned,
+                  100.0 * pairs_abandoned as f64 / (pairs_scored + pairs_abandoned).max(1) as f64);
+        eprintln!("{} of {} frames compared ({:.1}%)", frames_compared, frames_total, 100.0 * frames_compared as f64 / frames_total as f64);
+    }
     Ok(())
 }
@@ -1,15 +1,25 @@
 use super::song::Song;
-use std::cmp::min;
+use super::key_index::KeyIndex;
+use std::cmp::{min, Reverse};
+use std::sync::atomic::{AtomicU64, Ordering};
 
 const DEFAULT_MAX_MATCH_DURATION_DIFF: i32 = 5;
 const DEFAULT_MATCH_IMMEDIATE_THRESHOLD: f32 = 0.98;
 const DEFAULT_MATCH_PARTIAL_THRESHOLD: f32 = 0.98;
+const DEFAULT_MIN_KEY_HITS: u32 = 4;
+const EARLY_ABANDON_CHUNK: usize = 16; // Frames scored between two checks of the error bound
+const ALIGNMENT_VOTE_FRAMES: usize = 128; // Frames at the start of the songs that vote for an offset (about 16s)
+const MIN_ALIGNMENT_VOTES: usize = 8; // Unrelated prints get about one vote per offset by chance
+const ALIGNMENT_CANDIDATES: usize = 3; // Offsets with the most votes that get fully scored, on top of offset 0
 
 pub struct MatchParams
 {
     pub max_match_duration_diff: i32,
     pub match_immediate_threshold: f32,
     pub match_partial_threshold: f32,
+    pub key_bits: Option<u32>, // Only score the songs found in the key index, instead of every song in the duration window
+    pub min_key_hits: u32,
+    pub max_offset: usize, // Also try to align the prints shifted by up to this many frames (silence or a different intro pad)
 }
 
 impl Default for MatchParams {
@@ -18,32 +28,226 @@ impl Default for MatchParams {
             max_match_duration_diff: DEFAULT_MAX_MATCH_DURATION_DIFF,
             match_immediate_threshold: DEFAULT_MATCH_IMMEDIATE_THRESHOLD,
             match_partial_threshold: DEFAULT_MATCH_PARTIAL_THRESHOLD,
+            key_bits: None,
+            min_key_hits: DEFAULT_MIN_KEY_HITS,
+            max_offset: 0,
         }
     }
 }
 
-pub fn find_fingerprint_match<'a>(song: &'a Song, dst_songs: &'a [Song], params: &MatchParams) -> (Option<&'a Song>, f32) {
-    let mut best_score = 0.0;
-    let mut best_match: Option<&Song> = None;
+// Destination songs sorted by duration, so each source song only looks at the ones inside its duration window
+pub struct DurationIndex<'a> {
+    songs: Vec<&'a Song>,
+    keys: Option<KeyIndex>,
+}
+
+impl<'a> DurationIndex<'a> {
+    pub fn new(songs: &'a [Song], params: &MatchParams) -> Self {
+        let mut songs: Vec<_> = songs.iter().collect();
+        songs.sort_by_key(|song| song.duration); // Stable sort, songs of the same duration stay in input order
+        let keys = params.key_bits.map(|key_bits| KeyIndex::new(&songs, key_bits));
+        Self { songs, keys }
+    }
+
+    pub fn len(&self) -> usize {
+        self.songs.len()
+    }
+
+    pub fn song(&self, pos: usize) -> &'a Song {
+        self.songs[pos]
+    }
+
+    pub fn candidates(&self, song: &Song, params: &MatchParams) -> Vec<&'a Song> {
+        self.candidate_positions(song, 0, params).into_iter().map(|pos| self.songs[pos]).collect()
+    }
+
+    // Positions of the songs inside the duration window, skipping the ones before min_pos
+    pub fn candidate_positions(&self, song: &Song, min_pos: usize, params: &MatchParams) -> Vec<usize> {
+        let start = self.songs.partition_point(|dst_song| dst_song.duration < song.duration - params.max_match_duration_diff).max(min_pos);
+        let end = self.songs.partition_point(|dst_song| dst_song.duration <= song.duration + params.max_match_duration_diff).max(start);
+        match &self.keys {
+            Some(keys) => keys.lookup(&song.print, start, end, params.min_key_hits),
+            None => (start..end).collect(),
+        }
+    }
+}
+
+// Counters for --bench, added once per source song so the threads don't fight over them
+#[derive(Default)]
+pub struct MatchStats {
+    pub pairs_scored: AtomicU64,
+    pub pairs_abandoned: AtomicU64,
+    pub frames_compared: AtomicU64,
+    pub frames_total: AtomicU64, // What a full comparison of the same pairs would have looked at
+}
+
+impl MatchStats {
+    pub fn add(&self, counts: &PairCounts) {
+        self.pairs_scored.fetch_add(counts.pairs_scored, Ordering::Relaxed);
+        self.pairs_abandoned.fetch_add(counts.pairs_abandoned, Ordering::Relaxed);
+        self.frames_compared.fetch_add(counts.frames_compared, Ordering::Relaxed);
+        self.frames_total.fetch_add(counts.frames_total, Ordering::Relaxed);
+    }
+}
+
+#[derive(Default)]
+pub struct PairCounts {
+    pairs_scored: u64,
+    pairs_abandoned: u64,
+    frames_compared: u64,
+    frames_total: u64,
+    // Reused between the pairs of a source song
+    b_keys: Vec<u8>,
+    votes: Vec<(usize, i32)>,
+}
+
+impl PairCounts {
+    // Best score of the two songs and the offset it was found at, or None if it's certainly under min_useful_score.
+    // With several segments, that's the score of all the segments both songs have, weighted by their length.
+    // a_keys are the alignment keys of a (see song_alignment_keys), computed once for all the songs a is compared with.
+    pub fn score_pair(&mut self, a: &Song, a_keys: &[u8], b: &Song, min_useful_score: f32, max_offset: usize) -> Option<(f32, i32)> {
+        let mut votes = std::mem::take(&mut self.votes);
+        if max_offset > 0 {
+            fill_alignment_keys(&b.print, max_offset, &mut self.b_keys);
+        }
+        vote_offsets(a_keys, &self.b_keys, max_offset, &mut votes);
+        let mut best: Option<(f32, i32)> = None;
+        for offset in std::iter::once(0).chain(votes.iter().map(|&(_, offset)| offset)) {
+            let min_score = best.map_or(min_useful_score, |(best_score, _)| best_score.max(min_useful_score));
+            match self.score_alignment(a, b, offset, min_score) {
+                Some(score) if best.map_or(true, |(best_score, _)| score > best_score) => best = Some((score, offset)),
+                _ => (),
+            }
+        }
+        self.votes = votes;
+        if best.is_some() {
+            self.pairs_scored += 1;
+        } else {
+            self.pairs_abandoned += 1;
+        }
+        best
+    }
 
-    for dst_song in dst_songs.iter() {
-        if (song.duration - dst_song.duration).abs() > params.max_match_duration_diff {
-            continue;
+    // Score with frame i of a aligned on frame i+offset of b in each segment, or None if it's certainly under min_useful_score
+    fn score_alignment(&mut self, a: &Song, b: &Song, offset: i32, min_useful_score: f32) -> Option<f32> {
+        let segments = || a.segments().zip(b.segments()).map(move |(x, y)| align(x, y, offset));
+        let total_len: usize = segments().map(|(x, y)| min(x.len(), y.len())).sum();
+        let total_len = total_len.max(1);
+        let max_error = ((1.0 - min_useful_score).max(0.0) * 32.0 * total_len as f32) as u32 + 1; // +1 for the rounding of the score
+        let mut error = Some(0);
+        for (x, y) in segments() {
+            let (segment_error, frames) = bounded_print_error(x, y, error.unwrap(), max_error);
+            self.frames_compared += frames as u64;
+            error = segment_error;
+            if error.is_none() {
+                break;
+            }
         }
+        self.frames_total += total_len as u64;
+        error.map(|error| 1.0 - error as f32 / 32.0 / total_len as f32)
+    }
+}
+
+fn align<'a, 'b, T>(a: &'a [T], b: &'b [T], offset: i32) -> (&'a [T], &'b [T]) {
+    let shift = offset.unsigned_abs() as usize;
+    if offset >= 0 {
+        (a, &b[shift.min(b.len())..])
+    } else {
+        (&a[shift.min(a.len())..], b)
+    }
+}
+
+// Offsets worth fully scoring on top of 0, with their votes: the ones where the most frames of a have the same top 8 bits as the frame of b they're aligned with.
+// Few enough bits to survive the bit errors of a 0.8 match, and comparing bytes is cheap enough to try every offset.
+fn vote_offsets(a_keys: &[u8], b_keys: &[u8], max_offset: usize, votes: &mut Vec<(usize, i32)>) {
+    votes.clear();
+    let max_offset = max_offset as i32;
+    votes.extend((-max_offset..=max_offset).filter(|&offset| offset != 0).map(|offset| {
+        let (x, y) = align(a_keys, b_keys, offset);
+        let len = x.len().min(y.len()).min(ALIGNMENT_VOTE_FRAMES);
+        (x[..len].iter().zip(y[..len].iter()).map(|(p, q)| (p == q) as usize).sum::<usize>(), offset)
+    }).filter(|&(count, _)| count >= MIN_ALIGNMENT_VOTES));
+    votes.sort_by_key(|&(count, offset)| (Reverse(count), offset.abs()));
+    votes.truncate(ALIGNMENT_CANDIDATES);
+}
+
+fn fill_alignment_keys(print: &[i32], max_offset: usize, keys: &mut Vec<u8>) {
+    keys.clear();
+    keys.extend(print.iter().take(max_offset + ALIGNMENT_VOTE_FRAMES).map(|&frame| (frame as u32 >> 24) as u8));
+}
+
+// Keys of the first frames of a source song that vote for the offsets to try, empty without --max-offset
+pub fn song_alignment_keys(song: &Song, max_offset: usize) -> Vec<u8> {
+    let mut keys = Vec::new();
+    if max_offset > 0 {
+        fill_alignment_keys(&song.print, max_offset, &mut keys);
+    }
+    keys
+}
 
-        let mut error = 0f32;
-        for (x, y) in song.print.iter().zip(dst_song.print.iter()) {
-            error += (x ^ y).count_ones() as f32;
+// Hamming error between two prints added to the error so far, or None as soon as it goes over max_error. Also returns the number of frames compared.
+fn bounded_print_error(a: &[i32], b: &[i32], mut error: u32, max_error: u32) -> (Option<u32>, usize) {
+    let mut frames = 0;
+    for (a_chunk, b_chunk) in a.chunks(EARLY_ABANDON_CHUNK).zip(b.chunks(EARLY_ABANDON_CHUNK)) {
+        for (x, y) in a_chunk.iter().zip(b_chunk.iter()) {
+            error += (x ^ y).count_ones();
         }
-        let min_len = min(song.print.len(), dst_song.print.len()).max(1);
-        let score = 1.0 - error / 32.0 / min_len as f32;
+        frames += a_chunk.len().min(b_chunk.len());
+        if error > max_error {
+            return (None, frames);
+        }
+    }
+    (Some(error), frames)
+}
+
+// The first match over the immediate threshold, or else the best one over the partial threshold, with its score and offset
+pub fn find_fingerprint_match<'a>(song: &Song, dst_songs: &DurationIndex<'a>, params: &MatchParams, stats: &MatchStats) -> (Option<&'a Song>, f32, i32) {
+    let mut best_score = 0.0;
+    let mut best_offset = 0;
+    let mut best_match: Option<&Song> = None;
+    let mut counts = PairCounts::default();
+    let song_keys = song_alignment_keys(song, params.max_offset);
+
+    for dst_song in dst_songs.candidates(song, params) {
+        // Any pair scoring under this can't be returned, so stop once the error is too high to ever get there
+        let min_useful_score = params.match_immediate_threshold.min(params.match_partial_threshold.max(best_score));
+        let (score, offset) = match counts.score_pair(song, &song_keys, dst_song, min_useful_score, params.max_offset) {
+            Some(scored) => scored,
+            None => continue,
+        };
         if score >= params.match_immediate_threshold {
-            return (Some(dst_song), score);
+            stats.add(&counts);
+            return (Some(dst_song), score, offset);
         } else if score >= params.match_partial_threshold && score > best_score {
             best_score = score;
+            best_offset = offset;
             best_match = Some(dst_song);
         }
     }
 
-    (best_match, best_score)
+    stats.add(&counts);
+    (best_match, best_score, best_offset)
+}
+
+// The k best matches scoring at least min_score, best first, so the caller can apply any stricter threshold later
+pub fn find_top_matches<'a>(song: &Song, dst_songs: &DurationIndex<'a>, params: &MatchParams, k: usize, min_score: f32, stats: &MatchStats) -> Vec<(&'a Song, f32, i32)> {
+    let mut top: Vec<(&Song, f32, i32)> = Vec::with_capacity(k + 1);
+    let mut counts = PairCounts::default();
+    let song_keys = song_alignment_keys(song, params.max_offset);
+
+    for dst_song in dst_songs.candidates(song, params) {
+        let min_useful_score = if top.len() == k { top[k - 1].1 } else { min_score };
+        let (score, offset) = match counts.score_pair(song, &song_keys, dst_song, min_useful_score, params.max_offset) {
+            Some((score, offset)) if score >= min_score => (score, offset),
+            _ => continue,
+        };
+        let pos = top.iter().position(|&(_, top_score, _)| score > top_score).unwrap_or(top.len());
+        if pos < k {
+            top.insert(pos, (dst_song, score, offset));
+            top.truncate(k);
+        }
+    }
+
+    stats.add(&counts);
+    top
 }
@@ -0,0 +1,82 @@
+use super::song::Song;
+use std::borrow::Cow;
+use std::convert::TryInto;
+use std::io::{self, Read, Write};
+
+// Binary protocol of --binary, so the caller doesn't hex-encode prints that we would parse back, and reads matches as they're found.
+// Everything is little-endian.
+// Input: songs as records prefixed by their length (u32), groups of songs are separated by an empty record (a length of 0).
+// A record is the song id (u64), duration (i32), number of segments (u32), then for each segment its number of frames (u32) and frames (i32).
+// Output: for each source song with matches, its id (u64) and number of matches (u32), then for each match its id (u64), score (f32) and offset (i32).
+
+fn invalid_data(message: &str) -> io::Error {
+    io::Error::new(io::ErrorKind::InvalidData, message.to_owned())
+}
+
+// Splits the next size bytes off the record
+fn take<'a>(record: &mut &'a [u8], size: usize) -> io::Result<&'a [u8]> {
+    if record.len() < size {
+        return Err(invalid_data("Truncated song record"));
+    }
+    let (value, rest) = record.split_at(size);
+    *record = rest;
+    Ok(value)
+}
+
+fn take_u32(record: &mut &[u8]) -> io::Result<u32> {
+    Ok(u32::from_le_bytes(take(record, 4)?.try_into().unwrap()))
+}
+
+fn parse_song(mut record: &[u8]) -> io::Result<Song> {
+    let id = u64::from_le_bytes(take(&mut record, 8)?.try_into().unwrap());
+    let duration = i32::from_le_bytes(take(&mut record, 4)?.try_into().unwrap());
+    let num_segments = take_u32(&mut record)?;
+    let mut segments = Vec::with_capacity(num_segments as usize);
+    for _ in 0..num_segments {
+        let num_frames = take_u32(&mut record)? as usize;
+        let frames = take(&mut record, num_frames * 4)?;
+        segments.push(Cow::Owned(frames.chunks_exact(4).map(|frame| i32::from_le_bytes(frame.try_into().unwrap())).collect()));
+    }
+    if segments.is_empty() || !record.is_empty() {
+        return Err(invalid_data("Song records need at least one segment and nothing after the last one"));
+    }
+    let print = segments.remove(0);
+    Ok(Song { label: id.to_string(), print, extra_segments: segments, duration })
+}
+
+pub fn read_song_groups(input: &mut impl Read) -> io::Result<Vec<Vec<Song>>> {
+    let mut groups = vec![Vec::new()];
+    let mut len_bytes = [0u8; 4];
+    let mut record = Vec::new();
+    loop {
+        match input.read_exact(&mut len_bytes) {
+            Ok(()) => (),
+            Err(e) if e.kind() == io::ErrorKind::UnexpectedEof => break,
+            Err(e) => return Err(e),
+        }
+        let len = u32::from_le_bytes(len_bytes) as usize;
+        if len == 0 {
+            groups.push(Vec::new());
+            continue
+        }
+        record.resize(len, 0);
+        input.read_exact(&mut record)?;
+        groups.last_mut().unwrap().push(parse_song(&record)?);
+    }
+    Ok(groups)
+}
+
+// Written with a single call, so the matches of concurrent songs don't interleave
+pub fn write_matches(output: &mut impl Write, song: &Song, matches: &[(&Song, f32, i32)]) -> io::Result<()> {
+    let song_id = |song: &Song| song.label.parse::<u64>().map_err(|_| invalid_data("--binary output needs songs with an integer id"));
+    let mut buf = Vec::with_capacity(12 + 16 * matches.len());
+    buf.extend_from_slice(&song_id(song)?.to_le_bytes());
+    buf.extend_from_slice(&(matches.len() as u32).to_le_bytes());
+    for &(dst_song, score, offset) in matches {
+        buf.extend_from_slice(&song_id(dst_song)?.to_le_bytes());
+        buf.extend_from_slice(&score.to_le_bytes());
+        buf.extend_from_slice(&offset.to_le_bytes());
+    }
+    output.write_all(&buf)?;
+    output.flush()
+}
@@ -1,25 +1,49 @@
+use std::borrow::Cow;
+
 #[derive(Debug)]
 pub struct Song {
-    pub compressed_print: String,
-    pub print: Vec<i32>,
+    pub label: String, // What we print back for a match: the print as we got it, or the song id if there was one
+    pub print: Cow<'static, [i32]>, // Borrowed when the song comes from a memory-mapped index
+    pub extra_segments: Vec<Cow<'static, [i32]>>, // Prints of the following windows of the song, if we have them
     pub duration: i32,
 }
 
 impl Song {
-    pub fn new(line: &str) -> Song {
+    // Lines are "<duration> <print>", or "<id> <duration> <print>".
+    // The print can be followed by the prints of the next segments of the song, separated by ':'
+    pub fn new(line: &str, raw_print: bool) -> Song {
         let words: Vec<_> = line.split(' ').collect();
-        assert_eq!(words.len(), 2);
+        assert!(words.len() == 2 || words.len() == 3);
+        let (id, words) = if words.len() == 3 { (Some(words[0]), &words[1..]) } else { (None, &words[..]) };
         let duration = words[0].parse().unwrap();
-        let compressed_print = words[1].to_owned();
-        let print = Song::decode_print(&compressed_print);
+        let mut segments = words[1].split(':').map(|print| {
+            Cow::Owned(if raw_print {
+                Song::decode_raw_print(print)
+            } else {
+                Song::decode_print(print)
+            })
+        });
         Song {
-            compressed_print,
-            print,
+            label: id.unwrap_or(words[1]).to_owned(),
+            print: segments.next().unwrap(),
+            extra_segments: segments.collect(),
             duration,
         }
     }
 
+    pub fn segments(&self) -> impl Iterator<Item = &[i32]> {
+        std::iter::once(&*self.print).chain(self.extra_segments.iter().map(|segment| &**segment))
+    }
+
     pub fn decode_print(print: &str) -> Vec<i32> {
         chromaprint::Chromaprint::decode(print.as_bytes(), true).unwrap().0
     }
+
+    // Hex dump of the already decoded print, as stored in the song DB (little-endian 32bit integers)
+    pub fn decode_raw_print(print: &str) -> Vec<i32> {
+        print.as_bytes().chunks(8).map(|word| {
+            let word = std::str::from_utf8(word).unwrap();
+            u32::from_str_radix(word, 16).unwrap().swap_bytes() as i32
+        }).collect()
+    }
 }
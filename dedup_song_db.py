@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import argparse
+import subprocess
+import sqlite3
+
+parser = argparse.ArgumentParser(
+    description='Finds the clusters of duplicate songs inside a song DB, comparing every pair of songs once with the chromaprint matcher.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('db', metavar='db file', type=str, help='Song database built by build_song_db.py')
+parser.add_argument('-t', '--threshold', type=float, default=0.95, help='Lowest fingerprint match score between two duplicates')
+parser.add_argument('-d', '--duration-diff', type=int, default=5, help='Largest difference in seconds between two duplicates')
+parser.add_argument('--max-offset', type=int, default=16, help='Also look for duplicates shifted by up to this many fingerprint frames (about 0.124s each), like extra leading silence')
+parser.add_argument('--key-bits', type=int, help='Only compare songs sharing keys in the matcher index (faster, but may miss a few duplicates)')
+args = parser.parse_args()
+
+db = sqlite3.connect(args.db)
+songs_path = os.path.join(os.path.dirname(args.db), db.execute("SELECT value FROM info WHERE tag == 'songs_rel_path'").fetchone()[0])
+if db.execute("SELECT value FROM info WHERE tag == 'fingerprint_format'").fetchone() != ('raw_int32le',):
+    print(f'{args.db} uses an old fingerprint format, convert it with migrate_song_db.py first')
+    sys.exit(-1)
+segments = {}
+if db.execute("SELECT name FROM sqlite_master WHERE type == 'table' AND name == 'fingerprint_segments'").fetchone() is not None:
+    for content_hash, fingerprint in db.execute('SELECT content_hash, fingerprint FROM fingerprint_segments ORDER BY content_hash, segment'):
+        segments.setdefault(content_hash, []).append(fingerprint)
+rows = db.execute('SELECT rowid, artist, albums_path, title, format, duration, fingerprint, content_hash FROM songs').fetchall()
+db.close()
+song_paths = {rowid: os.path.join(songs_path, artist, albums_path, title+'.'+fmt) for rowid, artist, albums_path, title, fmt, duration, fingerprint, content_hash in rows}
+
+matcher_args = ['./chromaprint_matcher', '--raw-prints', '--self-dedup', '--partial-threshold', str(args.threshold), '--duration-diff', str(args.duration_diff), '--max-offset', str(args.max_offset)]
+if args.key_bits:
+    matcher_args += ['--key-bits', str(args.key_bits)]
+print(f'Looking for duplicates among {len(rows)} songs')
+with subprocess.Popen(matcher_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True) as matcher:
+    for rowid, artist, albums_path, title, fmt, duration, fingerprint, content_hash in rows:
+        prints = ':'.join(print_segment.hex() for print_segment in [fingerprint, *segments.get(content_hash, [])])
+        matcher.stdin.write(f'{rowid} {duration} {prints}\n')
+    matcher.stdin.close()
+
+    num_clusters = 0
+    num_duplicates = 0
+    for line in matcher.stdout:
+        cluster = json.loads(line)
+        num_clusters += 1
+        num_duplicates += len(cluster['songs']) - 1
+        print(f'Duplicate cluster of {len(cluster["songs"])} songs:')
+        for song_id in cluster['songs']:
+            print('  '+song_paths[int(song_id)])
+        for a, b, score, offset in cluster['links']:
+            shifted = f' (shifted by {offset} frames)' if offset else ''
+            print(f'  {score:.3f} {os.path.basename(song_paths[int(a)])} --- {os.path.basename(song_paths[int(b)])}{shifted}')
+if matcher.returncode != 0:
+    print('Chromaprint matcher failed')
+    sys.exit(-1)
+print(f'Found {num_clusters} clusters of duplicates, {num_duplicates} songs could be removed')
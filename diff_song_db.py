@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 import os
 import sys
+import json
 import shutil
 import subprocess
 import re
+import struct
 import sqlite3
 from time import sleep
 
@@ -11,6 +13,14 @@ READONLY = True # NOTE: DO NOT set to False before checking that the chromaprint
 CHROMAPRINT_PARTIAL_MATCH_THRESHOLD = 0.98
 SHOW_UNMATCHED = False
 NO_ART_IMPORT = True # If the source is using the "My Little X" cover arts from the MLPMA, we don't want those...
+MATCHER_INDEX_SUFFIX = '.matcher-index' # Decoded prints saved by the matcher next to each DB, so lowering the threshold step by step doesn't decode everything again
+MATCH_CANDIDATES_SUFFIX = '.match-candidates' # The matcher's best candidates for each source song, cached so the threshold can change without matching again
+MATCH_CANDIDATES_TOP_K = 5
+MATCH_CANDIDATES_MIN_SCORE = 0.80 # Going lower isn't worth it, see the README
+MATCH_MAX_OFFSET = 16 # In fingerprint frames (about 0.124s each), so songs with a bit of extra leading silence still match
+MATCHER_SONG_RECORD = struct.Struct('<QiI') # Binary protocol of the matcher (see protocol.rs): id, duration and number of segments of a song
+MATCHER_MATCHES_RECORD = struct.Struct('<QI') # Source song id and number of matches
+MATCHER_MATCH_ENTRY = struct.Struct('<Qfi') # Destination song id, score and offset of each match
 
 if len(sys.argv) < 3:
     print('Usage: '+sys.argv[0]+' <imported db> <target db> [-n]')
@@ -41,7 +51,8 @@ def process_artist(artist, rows):
             process_song(artist, artist_path, albums_path, song_file)
 
 class Song:
-    def __init__(self, songs_root_path, artist, albums_path, song_title, song_format, duration, bitrate, freq_cutoff, has_cover_art, fingerprint):
+    def __init__(self, songs_root_path, rowid, artist, albums_path, song_title, song_format, duration, bitrate, freq_cutoff, has_cover_art, fingerprint):
+        self.rowid = rowid
         self.artist = artist
         self.albums_path = albums_path
         self.title = song_title
@@ -50,37 +61,121 @@ class Song:
         self.bitrate = bitrate
         self.freq_cutoff = freq_cutoff
         self.has_cover_art = has_cover_art
-        self.fingerprint = fingerprint.decode('utf-8')
+        self.fingerprint = fingerprint # Raw little-endian int32 Chromaprint fingerprint
+        self.fingerprint_segments = [] # Fingerprints of the following windows of the song, if the DB has them
         self.rel_path = os.path.join(self.artist, self.albums_path, self.title+'.'+self.fmt)
         self.full_path = os.path.join(songs_root_path, self.artist, self.albums_path, self.title+'.'+self.fmt)
         self.match = None
         self.match_score = 0.0
+        self.match_offset = 0 # Fingerprint frames between the start of this song and its match
 
 def check_read_only_mode():
     if READONLY:
         print('! Read only mode is on, no change was made')
     return READONLY
 
+# Songs analyzed by older versions of build_song_db.py only have their first segment
+def import_fingerprint_segments(cur):
+    if cur.execute("SELECT name FROM sqlite_master WHERE type == 'table' AND name == 'fingerprint_segments'").fetchone() is None:
+        return {}
+    segments = {}
+    for content_hash, fingerprint in cur.execute('SELECT content_hash, fingerprint FROM fingerprint_segments ORDER BY content_hash, segment').fetchall():
+        segments.setdefault(content_hash, []).append(fingerprint)
+    return segments
+
 def import_songs(db_path):
     db = sqlite3.connect(db_path)
     cur = db.cursor()
     cur.execute("SELECT value FROM info WHERE tag == 'songs_rel_path'")
     songs_path = os.path.join(os.path.dirname(db_path), cur.fetchone()[0])
-    cur.execute('SELECT DISTINCT * FROM songs')
+    cur.execute("SELECT value FROM info WHERE tag == 'fingerprint_format'")
+    if cur.fetchone() != ('raw_int32le',):
+        print(f'{db_path} uses an old fingerprint format, convert it with migrate_song_db.py first')
+        sys.exit(-1)
+    segments = import_fingerprint_segments(cur)
+    cur.execute('SELECT rowid, artist, albums_path, title, format, duration, bitrate, freq_cutoff, has_cover_art, fingerprint, content_hash FROM songs')
 
+    # Exact duplicates are kept, they're different files that each need a match (use dedup_song_db.py to find them)
+    songs = []
     fingerprints = {}
     exact_dup_count = 0
     for row in cur.fetchall():
-        song = Song(songs_path, *row)
+        song = Song(songs_path, *row[:-1])
+        song.fingerprint_segments = segments.get(row[-1], [])
         if song.fingerprint in fingerprints:
             exact_dup_count += 1
             #print(f'# Exact duplicate {song.full_path} --- {fingerprints[song.fingerprint].full_path}')
         fingerprints[song.fingerprint] = song
+        songs.append(song)
     print(f'{str(exact_dup_count)} duplicates found (exact fingerprint match)')
 
     cur.close()
     db.close()
-    return fingerprints
+    return songs
+
+# Only rebuilt when the DB changed since the last time
+def build_matcher_index(db_path, songs):
+    index_path = db_path+MATCHER_INDEX_SUFFIX
+    db_mtime = max(os.path.getmtime(path) for path in [db_path, db_path+'-wal'] if os.path.exists(path))
+    if os.path.exists(index_path) and os.path.getmtime(index_path) > db_mtime:
+        return index_path
+    print('Building matcher index '+index_path)
+    with subprocess.Popen(['./chromaprint_matcher', '--binary', '--build-index', index_path], stdin=subprocess.PIPE) as matcher:
+        for song in songs:
+            prints = [song.fingerprint, *song.fingerprint_segments]
+            record = MATCHER_SONG_RECORD.pack(song.rowid, song.duration, len(prints)) + b''.join(struct.pack('<I', len(fingerprint)//4) + fingerprint for fingerprint in prints)
+            matcher.stdin.write(struct.pack('<I', len(record)) + record)
+    if matcher.returncode != 0:
+        print('Failed to build the matcher index '+index_path)
+        sys.exit(-1)
+    return index_path
+
+# Top candidates of each source song, best first, yielded as soon as the matcher finds them so the matches can be processed meanwhile.
+# Only runs the matcher if the indexes changed since the last time, the candidates are saved as JSON lines
+def find_match_candidates(src_index_path, dst_index_path):
+    cache_path = SRC_DB+MATCH_CANDIDATES_SUFFIX
+    cache_header = json.dumps({'dst_index': os.path.abspath(dst_index_path), 'top_k': MATCH_CANDIDATES_TOP_K, 'min_score': MATCH_CANDIDATES_MIN_SCORE, 'max_offset': MATCH_MAX_OFFSET})
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) > max(os.path.getmtime(src_index_path), os.path.getmtime(dst_index_path)):
+        with open(cache_path) as f:
+            if f.readline().rstrip('\n') == cache_header:
+                yield from (json.loads(line) for line in f)
+                return
+
+    print('Running chromaprint matcher to generate diff')
+    tmp_path = cache_path+'.tmp'
+    try:
+        with subprocess.Popen(['./chromaprint_matcher', '--binary', '--src-index', src_index_path, '--dst-index', dst_index_path,
+                               '--top-k', str(MATCH_CANDIDATES_TOP_K), '--min-score', str(MATCH_CANDIDATES_MIN_SCORE), '--max-offset', str(MATCH_MAX_OFFSET)], stdout=subprocess.PIPE) as matcher, \
+             open(tmp_path, 'w') as cache:
+            cache.write(cache_header+'\n')
+            while True:
+                record = matcher.stdout.read(MATCHER_MATCHES_RECORD.size)
+                if not record:
+                    break
+                src_id, num_matches = MATCHER_MATCHES_RECORD.unpack(record) if len(record) == MATCHER_MATCHES_RECORD.size else (None, 0)
+                entries = matcher.stdout.read(MATCHER_MATCH_ENTRY.size*num_matches)
+                if src_id is None or len(entries) != MATCHER_MATCH_ENTRY.size*num_matches:
+                    print('Chromaprint matcher output was cut short')
+                    sys.exit(-1)
+                candidates = {'src': src_id, 'matches': [{'dst': dst_id, 'score': score, 'offset': offset} for dst_id, score, offset in MATCHER_MATCH_ENTRY.iter_unpack(entries)]}
+                cache.write(json.dumps(candidates)+'\n')
+                yield candidates
+        if matcher.returncode != 0:
+            print('Chromaprint matcher failed')
+            sys.exit(-1)
+        os.replace(tmp_path, cache_path) # Only once all the candidates are there
+    finally:
+        if os.path.exists(tmp_path): # The matcher failed or we stopped early, don't leave partial candidates behind
+            os.remove(tmp_path)
+
+# Same candidates from the NumPy matcher, when the chromaprint matcher isn't built. Much slower, and without the offset search
+def find_match_candidates_in_process(src_songs, dst_songs):
+    import fingerprint_matcher
+    print('No chromaprint matcher binary, matching in Python')
+    src_prints = fingerprint_matcher.SongPrints((song.rowid, song.duration, [song.fingerprint, *song.fingerprint_segments]) for song in src_songs)
+    dst_prints = fingerprint_matcher.SongPrints((song.rowid, song.duration, [song.fingerprint, *song.fingerprint_segments]) for song in dst_songs)
+    top_matches = fingerprint_matcher.find_top_matches(src_prints, dst_prints, MATCH_CANDIDATES_TOP_K, MATCH_CANDIDATES_MIN_SCORE)
+    return [{'src': src_id, 'matches': [{'dst': dst_id, 'score': float(score), 'offset': 0} for dst_id, score in matches]} for src_id, matches in top_matches]
 
 def update_dst_db_song_cover_art(song):
     db = sqlite3.connect(TARGET_DB)
@@ -91,7 +186,7 @@ def update_dst_db_song_cover_art(song):
 def update_dst_db_song_replaced(src_song, dst_song):
     db = sqlite3.connect(TARGET_DB)
     db.execute('UPDATE songs SET duration=?, bitrate=?, freq_cutoff=?, fingerprint=? WHERE artist==? AND albums_path==? AND title==? AND format==?',
-               [src_song.duration, src_song.bitrate, src_song.freq_cutoff, src_song.fingerprint.encode(), dst_song.artist, dst_song.albums_path, dst_song.title, dst_song.fmt])
+               [src_song.duration, src_song.bitrate, src_song.freq_cutoff, src_song.fingerprint, dst_song.artist, dst_song.albums_path, dst_song.title, dst_song.fmt])
     db.commit()
     db.close()
     
@@ -99,6 +194,7 @@ def update_dst_db_song_replaced(src_song, dst_song):
     dst_song.bitrate = src_song.bitrate
     dst_song.freq_cutoff = src_song.freq_cutoff
     dst_song.fingerprint = src_song.fingerprint
+    dst_song.fingerprint_segments = src_song.fingerprint_segments
 
 def remove_parens(title):
     depth = 0
@@ -213,43 +309,46 @@ def process_fingerprint_match(src_song, dst_song):
     merge_best_of_songs(titles_match, src_song, dst_song)
 
 print('Importing source database')
-src_fingerprints = import_songs(SRC_DB)
-print(str(len(src_fingerprints))+' source fingerprints')
+src_songs = import_songs(SRC_DB)
+print(str(len(src_songs))+' source songs')
 print('Importing target database')
-dst_fingerprints = import_songs(TARGET_DB)
-print(str(len(dst_fingerprints))+' target fingerprints')
-
-print('Running chromaprint matcher to generate diff')
-
-matcher_stdout = None
-with subprocess.Popen(['./chromaprint_matcher', '--partial-threshold', str(CHROMAPRINT_PARTIAL_MATCH_THRESHOLD)], stderr=subprocess.PIPE, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True) as matcher:
-    for fingerprint in dst_fingerprints:
-        song = dst_fingerprints[fingerprint]
-        matcher.stdin.write(f'''{str(song.duration)} {song.fingerprint}\n''')
-    matcher.stdin.write('\n')
-    for fingerprint in src_fingerprints:
-        song = src_fingerprints[fingerprint]
-        matcher.stdin.write(f'''{str(song.duration)} {song.fingerprint}\n''')
-    matcher_stdout, stderr = matcher.communicate()
+dst_songs = import_songs(TARGET_DB)
+print(str(len(dst_songs))+' target songs')
+
+src_songs_by_id = {song.rowid: song for song in src_songs}
+dst_songs_by_id = {song.rowid: song for song in dst_songs}
+
+if os.path.exists('./chromaprint_matcher'):
+    src_index_path = build_matcher_index(SRC_DB, src_songs)
+    dst_index_path = build_matcher_index(TARGET_DB, dst_songs)
+    match_candidates = find_match_candidates(src_index_path, dst_index_path)
+else:
+    match_candidates = find_match_candidates_in_process(src_songs, dst_songs)
 
 print('Processing and importing matches')
 count_matching = 0
-for line in matcher_stdout.split('\n')[:-1]:
+count_shifted = 0
+for candidates in match_candidates:
+    best_match = candidates['matches'][0]
+    match_score = best_match['score']
+    if match_score < CHROMAPRINT_PARTIAL_MATCH_THRESHOLD:
+        continue
     count_matching += 1
-    src_print, match_print, match_score = line.split(' ');
-    src_song = src_fingerprints[src_print]
-    dst_song = dst_fingerprints[match_print]
+    src_song = src_songs_by_id[int(candidates['src'])]
+    dst_song = dst_songs_by_id[int(best_match['dst'])]
     src_song.match = dst_song
     src_song.match_score = match_score
+    src_song.match_offset = best_match['offset']
+    if src_song.match_offset != 0:
+        count_shifted += 1
     
     process_fingerprint_match(src_song, dst_song)
-print('Found '+str(count_matching)+' matching fingerprints, '+str(len(src_fingerprints)-count_matching)+' unmatched')
+print('Found '+str(count_matching)+' matching fingerprints ('+str(count_shifted)+' shifted), '+str(len(src_songs)-count_matching)+' unmatched')
 
 print('Processing artist folders')
 
 src_artists = {}
-for src_print in src_fingerprints:
-    src_song = src_fingerprints[src_print]
+for src_song in src_songs:
     if not src_song.artist in src_artists:
         src_artists[src_song.artist] = []
     src_artists[src_song.artist].append(src_song)
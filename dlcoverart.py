@@ -16,6 +16,7 @@ import soundcloud
 import binascii
 from html import unescape
 from time import sleep
+from audio_header import read_audio_header
 
 tracks = []
 localFiles = []
@@ -80,6 +81,9 @@ def removeFeats(titleFragment):
 
 def hasCoverArt(filePath):
     try:
+        header = read_audio_header(filePath)
+        if header is not None:
+            return header.has_cover_art
         escapedSrcPath = "'"+filePath.replace("'", "'\\''")+"'"
         result = subprocess.check_output(CMD_HAS_COVER+escapedSrcPath, shell=True)
         return 'DISPOSITION:attached_pic=1' in result.decode()
@@ -14,6 +14,7 @@ import tempfile
 import shutil
 import soundcloud
 from time import sleep
+from audio_header import read_audio_header
 
 tracks = []
 localFiles = []
@@ -28,6 +29,9 @@ SOUNDCLOUD_BORROWED_CLIENT_ID = '91f71f725804f4915f4cc95f69fff503' # First resul
 
 def hasCoverArt(filePath):
     try:
+        header = read_audio_header(filePath)
+        if header is not None:
+            return header.has_cover_art
         escapedSrcPath = "'"+filePath.replace("'", "'\\''")+"'"
         result = subprocess.check_output(CMD_HAS_COVER+escapedSrcPath, shell=True)
         return 'DISPOSITION:attached_pic=1' in result.decode()
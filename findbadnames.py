@@ -11,6 +11,7 @@ import subprocess
 import glob
 import numpy as np
 from time import sleep
+from audio_header import read_audio_header
 
 # This has false positives if the songs are numbered (i.e. Part 1/Part 2 or  No. I/No. II in title)
 CHECK_MISSPELLINGS=False
@@ -55,6 +56,9 @@ def levenshtein(seq1, seq2):
 
 def hasCoverArt(filePath):
     try:
+        header = read_audio_header(filePath)
+        if header is not None:
+            return header.has_cover_art
         escapedSrcPath = "'"+filePath.replace("'", "'\\''")+"'"
         result = subprocess.check_output(CMD_HAS_COVER+escapedSrcPath, shell=True)
         return 'DISPOSITION:attached_pic=1' in result.decode()
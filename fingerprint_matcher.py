@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+import numpy as np
+
+# In-process version of the chromaprint matcher, for when the Rust binary isn't built (or to call it as a library).
+# The prints are stored as zero-padded uint32 matrices, one per segment of the songs, and each block of source songs is compared
+# with all the destination songs of its duration window at once: XOR, popcount through a lookup table, and a sum over the frames.
+# Finds the same matches with the same scores as chromaprint_matcher without --key-bits or --max-offset (the prints are only compared from frame 0).
+
+DEFAULT_MAX_DURATION_DIFF = 5
+DEFAULT_IMMEDIATE_THRESHOLD = 0.98
+DEFAULT_PARTIAL_THRESHOLD = 0.98
+BLOCK_SRC_SONGS = 32 # Source songs compared at once
+BLOCK_FRAMES = 1 << 22 # Frames XORed at once, bounds the memory of a block (a few temporary arrays of 4 bytes per frame)
+
+POPCOUNT_LUT = np.array([bin(i).count('1') for i in range(1 << 16)], dtype=np.uint8) # Bits set in each 16 bit value
+
+class SongPrints:
+    # songs are (id, duration, [fingerprint, ...]) tuples, with the raw little-endian int32 fingerprints of each segment of the song as stored in the song DB
+    def __init__(self, songs):
+        songs = list(songs)
+        self.ids = [song_id for song_id, duration, segments in songs]
+        self.durations = np.array([duration for song_id, duration, segments in songs], dtype=np.int64)
+        num_segments = max((len(segments) for song_id, duration, segments in songs), default=0)
+
+        # For each segment: frames[segment][rows[segment][song]] is the print of that segment of the song, rows are -1 for songs that don't have it
+        self.rows = []
+        self.frames = []
+        self.lengths = []
+        for segment in range(num_segments):
+            prints = [np.frombuffer(segments[segment], dtype='<u4') if segment < len(segments) else None for song_id, duration, segments in songs]
+            rows = np.full(len(songs), -1, dtype=np.int64)
+            present = [i for i, print_ in enumerate(prints) if print_ is not None]
+            rows[present] = np.arange(len(present))
+            lengths = np.array([len(prints[i]) for i in present], dtype=np.int64)
+            frames = np.zeros((len(present), lengths.max(initial=0)), dtype=np.uint32)
+            for row, i in enumerate(present):
+                frames[row, :len(prints[i])] = prints[i]
+            self.rows.append(rows)
+            self.frames.append(frames)
+            self.lengths.append(lengths)
+
+    def __len__(self):
+        return len(self.ids)
+
+# Bits set in each uint32. NumPy 2 has a popcount instruction about 6x faster than the table lookups
+def popcount(values):
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    return POPCOUNT_LUT[values & 0xFFFF] + POPCOUNT_LUT[values >> 16]
+
+# Scores between the src songs at src_pos and the dst songs at dst_pos: the score of all the segments both songs have, weighted by their length.
+# Computed in float32 like the Rust matcher, so the scores and thresholds compare exactly the same
+def score_block(src, dst, src_pos, dst_pos):
+    error = np.zeros((len(src_pos), len(dst_pos)), dtype=np.int64)
+    total_len = np.zeros((len(src_pos), len(dst_pos)), dtype=np.int64)
+    for segment in range(min(len(src.frames), len(dst.frames))):
+        src_rows = src.rows[segment][src_pos]
+        dst_rows = dst.rows[segment][dst_pos]
+        src_present = np.nonzero(src_rows >= 0)[0]
+        dst_present = np.nonzero(dst_rows >= 0)[0]
+        if len(src_present) == 0 or len(dst_present) == 0:
+            break # Songs with a segment have all the ones before it
+        src_lengths = src.lengths[segment][src_rows[src_present]]
+        dst_lengths = dst.lengths[segment][dst_rows[dst_present]]
+        width = min(src.frames[segment].shape[1], dst.frames[segment].shape[1])
+        a = src.frames[segment][src_rows[src_present], :width]
+        b = dst.frames[segment][dst_rows[dst_present], :width]
+        common_len = np.minimum(src_lengths[:, None], dst_lengths[None, :])
+        # Only the frames both prints have count, the padding of the shorter one would otherwise pick up the bits of the longer one
+        in_common = np.arange(width)[None, None, :] < common_len[:, :, None]
+        segment_error = (popcount(a[:, None, :] ^ b[None, :, :]) * in_common).sum(axis=2, dtype=np.int64)
+        error[np.ix_(src_present, dst_present)] += segment_error
+        total_len[np.ix_(src_present, dst_present)] += common_len
+    total_len = np.maximum(total_len, 1)
+    return np.float32(1.0) - error.astype(np.float32) / np.float32(32.0) / total_len.astype(np.float32)
+
+# Yields (src positions, dst positions in duration order, scores) for blocks of source songs and chunks of their duration windows, in increasing duration
+# order of the destination songs. Pairs outside the duration window of their source song have a score of -1.
+def scored_blocks(src, dst, max_duration_diff):
+    dst_order = np.argsort(dst.durations, kind='stable') # Same candidate order as the matcher, songs of the same duration stay in input order
+    dst_durations = dst.durations[dst_order]
+    src_order = np.argsort(src.durations, kind='stable')
+    width = max((frames.shape[1] for frames in dst.frames), default=1)
+    for block_start in range(0, len(src), BLOCK_SRC_SONGS):
+        src_pos = src_order[block_start:block_start+BLOCK_SRC_SONGS]
+        src_durations = src.durations[src_pos]
+        window_start = np.searchsorted(dst_durations, src_durations.min() - max_duration_diff, side='left')
+        window_end = np.searchsorted(dst_durations, src_durations.max() + max_duration_diff, side='right')
+        chunk_size = max(1, BLOCK_FRAMES // (len(src_pos) * max(width, 1)))
+        for chunk_start in range(window_start, window_end, chunk_size):
+            dst_pos = dst_order[chunk_start:min(chunk_start+chunk_size, window_end)]
+            scores = score_block(src, dst, src_pos, dst_pos)
+            duration_diff = np.abs(src_durations[:, None] - dst.durations[dst_pos][None, :])
+            yield src_pos, dst_pos, np.where(duration_diff <= max_duration_diff, scores, np.float32(-1.0))
+
+# (src id, dst id, score) of each source song with a match, in source order: the first candidate scoring at least the immediate threshold,
+# or else the best one scoring at least the partial threshold
+def find_matches(src, dst, max_duration_diff=DEFAULT_MAX_DURATION_DIFF, immediate_threshold=DEFAULT_IMMEDIATE_THRESHOLD, partial_threshold=DEFAULT_PARTIAL_THRESHOLD):
+    immediate_threshold = np.float32(immediate_threshold)
+    partial_threshold = np.float32(partial_threshold)
+    done = np.zeros(len(src), dtype=bool)
+    best_score = np.zeros(len(src), dtype=np.float32)
+    best_match = np.full(len(src), -1, dtype=np.int64)
+    for src_pos, dst_pos, scores in scored_blocks(src, dst, max_duration_diff):
+        active = ~done[src_pos]
+        immediate = scores >= immediate_threshold
+        first_immediate = immediate.argmax(axis=1)
+        has_immediate = active & immediate.any(axis=1)
+        rows = np.nonzero(has_immediate)[0]
+        best_match[src_pos[rows]] = dst_pos[first_immediate[rows]]
+        best_score[src_pos[rows]] = scores[rows, first_immediate[rows]]
+        done[src_pos[rows]] = True
+
+        partial = np.where(scores >= partial_threshold, scores, np.float32(-1.0))
+        chunk_best = partial.argmax(axis=1) # First of the best, like the matcher only replacing its best match with a strictly better one
+        chunk_best_score = partial[np.arange(len(src_pos)), chunk_best]
+        rows = np.nonzero(active & ~has_immediate & (chunk_best_score > best_score[src_pos]))[0]
+        best_match[src_pos[rows]] = dst_pos[chunk_best[rows]]
+        best_score[src_pos[rows]] = chunk_best_score[rows]
+    return [(src.ids[i], dst.ids[best_match[i]], best_score[i]) for i in range(len(src)) if best_match[i] >= 0]
+
+# (src id, [(dst id, score), ...]) of each source song with matches, in source order: up to k matches scoring at least min_score, best first
+def find_top_matches(src, dst, k, min_score=0.8, max_duration_diff=DEFAULT_MAX_DURATION_DIFF):
+    min_score = np.float32(min_score)
+    candidates = [[] for _ in range(len(src))]
+    for src_pos, dst_pos, scores in scored_blocks(src, dst, max_duration_diff):
+        for row, col in zip(*np.nonzero(scores >= min_score)):
+            candidates[src_pos[row]].append((dst_pos[col], scores[row, col]))
+    top_matches = []
+    for i, song_candidates in enumerate(candidates):
+        if song_candidates:
+            song_candidates.sort(key=lambda candidate: -candidate[1]) # Stable sort, ties keep the candidate order
+            top_matches.append((src.ids[i], [(dst.ids[pos], score) for pos, score in song_candidates[:k]]))
+    return top_matches
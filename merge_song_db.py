@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+import os
+import sys
+import argparse
+import sqlite3
+from song_db import create_tables, remove_unused_analysis, artist_shard, FINGERPRINT_FORMAT
+
+SONG_COLUMNS = 'artist, albums_path, title, format, duration, bitrate, freq_cutoff, has_cover_art, fingerprint, size, mtime, inode, content_hash'
+ANALYSIS_COLUMNS = 'content_hash, duration, bitrate, freq_cutoff, has_cover_art, fingerprint'
+SPECTRUM_COLUMNS = 'content_hash, sample_rate, power_db'
+SEGMENT_COLUMNS = 'content_hash, segment, fingerprint'
+
+def get_info(db, schema, tag):
+    row = db.execute(f'SELECT value FROM {schema}.info WHERE tag == ?', [tag]).fetchone()
+    return row[0] if row else None
+
+parser = argparse.ArgumentParser(
+    description='Merges the song DBs built by build_song_db.py --shard into a single song DB.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('db', metavar='db file', type=str, help='The merged song database to create or update')
+parser.add_argument('shards', metavar='shard db file', type=str, nargs='+', help='Song databases built with --shard')
+parser.add_argument('-f', '--force', action='store_true', help='Merge even if some shards are missing')
+args = parser.parse_args()
+
+db = sqlite3.connect(args.db)
+db.execute('PRAGMA journal_mode=WAL')
+create_tables(db)
+if db.execute('SELECT COUNT(*) FROM songs').fetchone()[0] == 0:
+    db.execute('''INSERT OR REPLACE INTO info VALUES ('fingerprint_format', ?)''', [FINGERPRINT_FORMAT])
+elif get_info(db, 'main', 'fingerprint_format') != FINGERPRINT_FORMAT:
+    print(f'{args.db} uses an old fingerprint format, convert it with migrate_song_db.py first')
+    sys.exit(-1)
+db.commit() # Can't detach the shards while a transaction is open
+
+# Check that we have every shard exactly once before touching anything
+artists_path = None
+shards_seen = set()
+num_shards = None
+for shard_path in args.shards:
+    if not os.path.exists(shard_path):
+        print(f'{shard_path} not found')
+        sys.exit(-1)
+    db.execute('ATTACH DATABASE ? AS shard', [shard_path])
+    shard = get_info(db, 'shard', 'shard')
+    fingerprint_format = get_info(db, 'shard', 'fingerprint_format')
+    songs_rel_path = get_info(db, 'shard', 'songs_rel_path')
+    build_journal_size = db.execute('SELECT COUNT(*) FROM shard.build_journal').fetchone()[0]
+    db.execute('DETACH DATABASE shard')
+
+    if shard is None:
+        print(f'{shard_path} was not built with --shard')
+        sys.exit(-1)
+    if fingerprint_format != FINGERPRINT_FORMAT:
+        print(f'{shard_path} uses an old fingerprint format, convert it with migrate_song_db.py first')
+        sys.exit(-1)
+    if build_journal_size:
+        print(f'The build of {shard_path} was interrupted with {build_journal_size} songs left, run build_song_db.py on it again first')
+        sys.exit(-1)
+    index, shard_count = [int(x) for x in shard.split('/')]
+    if num_shards is not None and shard_count != num_shards:
+        print(f'{shard_path} is shard {shard}, but the previous shards were built for {num_shards} shards')
+        sys.exit(-1)
+    if index in shards_seen:
+        print(f'Shard {shard} was given twice')
+        sys.exit(-1)
+    num_shards = shard_count
+    shards_seen.add(index)
+
+    shard_artists_path = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(shard_path)), songs_rel_path))
+    if artists_path is not None and shard_artists_path != artists_path:
+        print(f'Warning: {shard_path} was built from {shard_artists_path} instead of {artists_path}')
+    artists_path = artists_path or shard_artists_path
+
+missing_shards = sorted(set(range(num_shards)) - shards_seen)
+if missing_shards:
+    print('Missing shards: '+', '.join(f'{index}/{num_shards}' for index in missing_shards))
+    if not args.force:
+        sys.exit(-1)
+
+# Each shard replaces all the songs of its artists, so the songs removed or renamed since the last merge don't stay behind
+db.create_function('artist_shard', 2, artist_shard, deterministic=True)
+for shard_path in args.shards:
+    db.execute('ATTACH DATABASE ? AS shard', [shard_path])
+    index = int(get_info(db, 'shard', 'shard').split('/')[0])
+    db.execute('DELETE FROM songs WHERE artist_shard(artist, ?) == ?', [num_shards, index])
+    num_songs = db.execute(f'INSERT OR REPLACE INTO songs ({SONG_COLUMNS}) SELECT {SONG_COLUMNS} FROM shard.songs').rowcount
+    db.execute(f'INSERT OR IGNORE INTO analysis_cache ({ANALYSIS_COLUMNS}) SELECT {ANALYSIS_COLUMNS} FROM shard.analysis_cache')
+    db.execute(f'INSERT OR IGNORE INTO spectra ({SPECTRUM_COLUMNS}) SELECT {SPECTRUM_COLUMNS} FROM shard.spectra')
+    db.execute(f'INSERT OR IGNORE INTO fingerprint_segments ({SEGMENT_COLUMNS}) SELECT {SEGMENT_COLUMNS} FROM shard.fingerprint_segments')
+    db.commit()
+    db.execute('DETACH DATABASE shard')
+    print(f'Merged {num_songs} songs from {shard_path}')
+
+db.execute('''INSERT OR REPLACE INTO info VALUES ('songs_rel_path', ?)''', [os.path.relpath(artists_path, os.path.dirname(os.path.abspath(args.db)))])
+db.execute('''DELETE FROM info WHERE tag == 'shard' ''')
+db.commit()
+remove_unused_analysis(db)
+db.close()
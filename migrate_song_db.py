@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+import os
+import sys
+import argparse
+import sqlite3
+from song_db import migrate_fingerprints
+
+parser = argparse.ArgumentParser(
+    description='Converts the fingerprints of song DBs from older versions (like the snapshots of past releases) to the current format, without touching anything else in them.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('dbs', metavar='db file', type=str, nargs='+', help='Song databases built by older versions of build_song_db.py')
+args = parser.parse_args()
+
+for db_path in args.dbs:
+    if not os.path.exists(db_path):
+        print(f'{db_path} not found')
+        sys.exit(-1)
+    db = sqlite3.connect(db_path)
+    print(f'Migrating {db_path}')
+    migrate_fingerprints(db)
+    db.close()
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+import sys
+import argparse
+import sqlite3
+import numpy
+from song_db import frequency_cutoff_search_batch, SPECTRUM_DB_DTYPE, CUTOFF_SEARCH_SEGMENT_WIDTH, CUTOFF_MIN_DB_DROP, CUTOFF_LOWEST_LEVEL
+
+parser = argparse.ArgumentParser(
+    description='Recomputes the frequency cutoff of every song from the spectra stored in the song DB, without decoding anything.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('db', metavar='db file', type=str, help='Song database built by build_song_db.py')
+parser.add_argument('--segment-width', type=int, default=CUTOFF_SEARCH_SEGMENT_WIDTH, help='Distance to lookahead for the drop, as a fraction of the search space')
+parser.add_argument('--min-db-drop', type=float, default=CUTOFF_MIN_DB_DROP, help='Drop in dB over a segment that counts as the cutoff')
+parser.add_argument('--lowest-level', type=float, default=CUTOFF_LOWEST_LEVEL, help='Level above the floor in dB where we stop looking for a drop')
+parser.add_argument('-n', '--dry-run', action='store_true', help='Only show how many cutoffs would change, without updating the DB')
+args = parser.parse_args()
+
+db = sqlite3.connect(args.db)
+rows = db.execute('SELECT spectra.content_hash, sample_rate, power_db, freq_cutoff FROM spectra JOIN analysis_cache ON spectra.content_hash == analysis_cache.content_hash').fetchall()
+if not rows:
+    print('No spectra found in this DB, songs analyzed by older versions of build_song_db.py need to be analyzed again')
+    sys.exit(-1)
+
+freqs = numpy.array([row[1] for row in rows])
+power_db = numpy.stack([numpy.frombuffer(row[2], dtype=SPECTRUM_DB_DTYPE) for row in rows]).astype(numpy.float32)
+old_cutoffs = numpy.array([row[3] for row in rows], dtype=float)
+cutoffs = frequency_cutoff_search_batch(power_db, freqs, int(power_db.shape[1]/args.segment_width), args.min_db_drop, args.lowest_level)
+
+changed = numpy.nonzero(cutoffs != old_cutoffs)[0]
+print(f'{len(changed)} of {len(rows)} cutoffs changed')
+if len(changed):
+    print(f'Average cutoff went from {numpy.mean(old_cutoffs[changed]):.0f}Hz to {numpy.mean(cutoffs[changed]):.0f}Hz for the changed songs')
+if args.dry_run or not len(changed):
+    sys.exit(0)
+
+db.executemany('UPDATE analysis_cache SET freq_cutoff=? WHERE content_hash == ?', [[float(cutoffs[i]), rows[i][0]] for i in changed])
+db.execute('''UPDATE songs SET freq_cutoff=(SELECT freq_cutoff FROM analysis_cache WHERE analysis_cache.content_hash == songs.content_hash)
+              WHERE content_hash IN (SELECT content_hash FROM spectra)''')
+db.commit()
+db.close()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+import base64
+import hashlib
+import numpy
+
+# Schema of the song DB and the frequency cutoff search, shared by build_song_db.py and the tools working on its DBs.
+# Kept apart so those tools don't need acoustid and libchromaprint.
+
+FINGERPRINT_FORMAT = 'raw_int32le' # Decoded Chromaprint fingerprint, an array of little-endian 32bit integers
+
+# Cutoff frequency search parameters
+CUTOFF_SEARCH_START_FREQ = 5000 # There's no sense looking for a cutoff lower than 5kHz, if there's a song that poorly encoded I can only hope it's "artistic choice"
+CUTOFF_SEARCH_SEGMENT_WIDTH = 50 # Distance to lookahead for the drop, as a fraction of the frequency (search space)
+CUTOFF_MIN_DB_DROP = 15 # If we see a drop this many dB tall in a segment, we found the cutoff
+CUTOFF_LOWEST_LEVEL = +15 # If we reach a level this many dB above the floor, there must not have been a sharp drop, so we cutoff here.
+
+SPECTRUM_DB_DTYPE = numpy.dtype('<f2') # FFT_LENGTH/2+1 (build_song_db.py) bins of normalized power in dB, as stored in the spectra table
+
+# Same search over many spectra at once (one per row), in case we want to try different parameters on a whole archive
+# For each song we return the position of the first sharp drop, unless we reach the floor level before that.
+def frequency_cutoff_search_batch(power_db, freqs, dx, db_drop, lowest_level):
+    num_bins = power_db.shape[1]
+    if num_bins <= dx:
+        return freqs.astype(float)
+    start_pos = (CUTOFF_SEARCH_START_FREQ * num_bins / freqs).astype(int)
+    pos_to_freq = freqs/num_bins/2
+    positions = numpy.arange(num_bins-dx)
+    searched = positions >= start_pos[:, numpy.newaxis]
+    with numpy.errstate(invalid='ignore'): # Silent bins are -inf dB
+        drops = searched & (power_db[:, :num_bins-dx] - power_db[:, dx:] > db_drop)
+        floors = searched & (power_db[:, :num_bins-dx] - power_db[:, -1:] < lowest_level)
+    first_drop = drops.argmax(axis=1)
+    first_floor = numpy.where(floors.any(axis=1), floors.argmax(axis=1), num_bins)
+    found = drops.any(axis=1) & (first_drop <= first_floor)
+    return numpy.where(found, (first_drop + dx//2) * pos_to_freq, freqs).astype(float)
+
+# Artists are spread over shards by a stable hash of their folder name, so every machine agrees on who builds what
+def artist_shard(artist, num_shards):
+    return int.from_bytes(hashlib.blake2b(artist.encode(), digest_size=8).digest(), 'little') % num_shards
+
+# Values packed bits_per_value bits at a time in a little-endian bit stream, like Chromaprint packs its compressed fingerprints
+def unpack_int_array(data, bits_per_value):
+    bits = numpy.unpackbits(numpy.frombuffer(data, dtype=numpy.uint8), bitorder='little')
+    bits = bits[:len(bits) - len(bits) % bits_per_value].reshape(-1, bits_per_value)
+    return bits @ (1 << numpy.arange(bits_per_value))
+
+# Pure NumPy version of chromaprint.decode_fingerprint, for the fingerprints of older DBs: Chromaprint's compressed base64 format
+# (algorithm, number of frames, 3 bit deltas between the set bits of each frame XOR the previous one, 5 bit extensions of the deltas that didn't fit)
+def decode_compressed_fingerprint(compressed_fingerprint):
+    if isinstance(compressed_fingerprint, str):
+        compressed_fingerprint = compressed_fingerprint.encode()
+    data = base64.urlsafe_b64decode(compressed_fingerprint + b'=' * (-len(compressed_fingerprint) % 4))
+    if len(data) < 4:
+        raise ValueError('Invalid compressed fingerprint')
+    num_frames = int.from_bytes(data[1:4], 'big')
+    deltas = unpack_int_array(data[4:], 3)
+    frame_ends = numpy.nonzero(deltas == 0)[0]
+    if len(frame_ends) < num_frames:
+        raise ValueError('Invalid compressed fingerprint')
+    if num_frames == 0:
+        return b''
+    deltas = deltas[:frame_ends[num_frames-1] + 1]
+    extended = numpy.nonzero(deltas == 7)[0]
+    if len(extended):
+        extensions = unpack_int_array(data[4 + (len(deltas)*3 + 7)//8:], 5)
+        if len(extensions) < len(extended):
+            raise ValueError('Invalid compressed fingerprint')
+        deltas[extended] += extensions[:len(extended)]
+    # Bit positions are the running sum of the deltas since the start of their frame
+    frame = numpy.cumsum(deltas == 0) - (deltas == 0)
+    positions = numpy.cumsum(deltas)
+    positions -= numpy.concatenate(([0], positions[frame_ends[:num_frames-1]]))[frame]
+    is_bit = deltas != 0
+    frames = numpy.zeros(num_frames, dtype=numpy.uint32)
+    numpy.bitwise_or.at(frames, frame[is_bit], (numpy.uint32(1) << (positions[is_bit] - 1).astype(numpy.uint32)))
+    return numpy.bitwise_xor.accumulate(frames).astype('<u4').tobytes()
+
+def migrate_fingerprints(db):
+    # DBs from older versions hold Chromaprint's compressed base64 fingerprints
+    if db.execute("SELECT value FROM info WHERE tag == 'fingerprint_format'").fetchone() is not None:
+        return
+    for table, key in [('songs', 'rowid'), ('analysis_cache', 'content_hash')]:
+        if db.execute("SELECT name FROM sqlite_master WHERE type == 'table' AND name == ?", [table]).fetchone() is None:
+            continue # DBs from before the analysis cache
+        rows = db.execute(f'SELECT {key}, fingerprint FROM {table}').fetchall()
+        if rows:
+            print(f'Converting {len(rows)} fingerprints of the {table} table to the {FINGERPRINT_FORMAT} format')
+        db.executemany(f'UPDATE {table} SET fingerprint=? WHERE {key} == ?', [[decode_compressed_fingerprint(fingerprint), row_key] for row_key, fingerprint in rows])
+    db.execute("INSERT INTO info VALUES ('fingerprint_format', ?)", [FINGERPRINT_FORMAT])
+    db.commit()
+
+# The analysis tables are keyed by file content, so rows of replaced or re-tagged files and removed songs stay behind until we drop the ones no song uses
+def remove_unused_analysis(db):
+    for table in ['analysis_cache', 'spectra', 'fingerprint_segments']:
+        num_rows = db.execute(f'DELETE FROM {table} WHERE content_hash NOT IN (SELECT content_hash FROM songs WHERE content_hash IS NOT NULL)').rowcount
+        if num_rows:
+            print(f'Removed {num_rows} unused rows from the {table} table')
+    db.commit()
+
+def add_missing_columns(db, table, columns):
+    # Upgrades DBs created by older versions of build_song_db.py
+    existing_columns = [row[1] for row in db.execute(f'PRAGMA table_info({table})')]
+    for name, column_type in columns:
+        if name not in existing_columns:
+            db.execute(f'ALTER TABLE {table} ADD COLUMN {name} {column_type}')
+
+def create_tables(db):
+    db.execute('''CREATE TABLE IF NOT EXISTS songs (
+        artist TEXT NOT NULL,
+        albums_path TEXT NOT NULL,
+        title TEXT NOT NULL,
+        format TEXT NOT NULL,
+        duration INTEGER NOT NULL,
+        bitrate INTEGER,
+        freq_cutoff REAL,
+        has_cover_art INTEGER NOT NULL,
+        fingerprint BLOB NOT NULL,
+        size INTEGER,
+        mtime INTEGER,
+        inode INTEGER,
+        content_hash BLOB,
+        UNIQUE(artist, albums_path, title)
+        )''')
+    add_missing_columns(db, 'songs', [('size', 'INTEGER'), ('mtime', 'INTEGER'), ('inode', 'INTEGER'), ('content_hash', 'BLOB')])
+    # Analysis results by file content, so they survive the song being renamed or moved around
+    db.execute('''CREATE TABLE IF NOT EXISTS analysis_cache (
+        content_hash BLOB PRIMARY KEY,
+        duration INTEGER NOT NULL,
+        bitrate INTEGER,
+        freq_cutoff REAL,
+        has_cover_art INTEGER NOT NULL,
+        fingerprint BLOB NOT NULL
+        )''')
+    # Welch power curve of each song (normalized dB, SPECTRUM_DB_DTYPE), to tune the cutoff search without decoding everything again
+    db.execute('''CREATE TABLE IF NOT EXISTS spectra (
+        content_hash BLOB PRIMARY KEY,
+        sample_rate INTEGER NOT NULL,
+        power_db BLOB NOT NULL
+        )''')
+    # Fingerprints of the following FINGERPRINT_SEGMENT_LENGTH (build_song_db.py) windows of each song (segment 0 is the fingerprint column of analysis_cache),
+    # so the matcher can tell apart songs that only have the same beginning. Songs analyzed by older versions have none.
+    db.execute('''CREATE TABLE IF NOT EXISTS fingerprint_segments (
+        content_hash BLOB NOT NULL,
+        segment INTEGER NOT NULL,
+        fingerprint BLOB NOT NULL,
+        PRIMARY KEY(content_hash, segment)
+        )''')
+    db.execute('''CREATE TABLE IF NOT EXISTS build_journal (
+        artist TEXT NOT NULL,
+        albums_path TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime INTEGER NOT NULL,
+        inode INTEGER NOT NULL,
+        UNIQUE(artist, albums_path, filename)
+        )''')
+    db.execute('''CREATE INDEX IF NOT EXISTS idx_artist ON songs(artist)''')
+    db.execute('''CREATE TABLE IF NOT EXISTS info (tag text UNIQUE, value text)''')